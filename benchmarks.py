@@ -0,0 +1,268 @@
+# Copyright (C) 2018 Arrai Innovations Inc. - All Rights Reserved
+"""
+Times each phase of extraneous against synthetic environments of fake *.dist-info directories, without installing
+anything. Results can be written as JSON and compared against an earlier run to catch regressions:
+
+    python benchmarks.py --output baseline.json
+    python benchmarks.py --baseline baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+from tempfile import TemporaryDirectory
+
+from extraneous.extraneous import (
+    build_installed_graph,
+    find_extraneous,
+    find_requirements_unique_to_projects,
+    list_path_item,
+    read_distribution,
+    read_installed,
+    read_requirements,
+)
+
+results_version = 1
+default_sizes = [100, 1000, 10000]
+
+
+def package_name(index):
+    return "bench-package-{}".format(index)
+
+
+def write_distribution(site_packages, index, requires, editable=False):
+    dist_info = os.path.join(site_packages, "bench_package_{}-1.0.dist-info".format(index))
+    os.makedirs(dist_info)
+    with open(os.path.join(dist_info, "METADATA"), "w") as w:
+        w.write(
+            "Metadata-Version: 2.1\nName: {}\nVersion: 1.0\nSummary: benchmark package\n".format(package_name(index))
+        )
+        for requirement in requires:
+            w.write("Requires-Dist: {} (>=1.0)\n".format(package_name(requirement)))
+        # a marker that never applies, so marker evaluation is part of the timings.
+        w.write("Requires-Dist: bench-never-installed ; python_version < '3'\n")
+        w.write("\nLong description, which readers of the headers don't need.\n" * 20)
+    if editable:
+        with open(os.path.join(dist_info, "direct_url.json"), "w") as w:
+            json.dump({"url": "file:///src/{}".format(package_name(index)), "dir_info": {"editable": True}}, w)
+
+
+def generate_environment(root, packages, fan_out=3, depth=4, cycles=0, editable=0, requirements=None, seed=0):
+    """
+    Writes packages fake distributions to root/site-packages, split into depth layers where each package requires
+    fan_out packages of the next layer, plus cycles edges back to earlier layers. The first editable packages are
+    editable installs. root/requirements.txt lists requirements of the top layer packages, half of them by default,
+    through a -r include so the reference handling is timed too. Returns the site-packages directory.
+    """
+    rng = random.Random(seed)
+    depth = max(1, min(depth, packages))
+    layers = [list(range(packages))[layer::depth] for layer in range(depth)]
+    requires = {index: set() for index in range(packages)}
+    for layer, next_layer in zip(layers, layers[1:]):
+        for index in layer:
+            requires[index].update(rng.sample(next_layer, min(fan_out, len(next_layer))))
+    for _ in range(cycles if depth > 1 else 0):
+        layer = rng.randrange(1, depth)
+        requires[rng.choice(layers[layer])].add(rng.choice(layers[rng.randrange(0, layer)]))
+    site_packages = os.path.join(root, "site-packages")
+    os.makedirs(site_packages)
+    for index in range(packages):
+        write_distribution(site_packages, index, sorted(requires[index]), editable=index < editable)
+    if requirements is None:
+        requirements = max(1, len(layers[0]) // 2)
+    required = layers[0][:requirements]
+    half = len(required) // 2
+    with open(os.path.join(root, "requirements.txt"), "w") as w:
+        w.write("# generated by benchmarks.py\n-r included.txt\n")
+        for index in required[:half]:
+            w.write("{}>=1.0  # pinned loosely\n".format(package_name(index)))
+    with open(os.path.join(root, "included.txt"), "w") as w:
+        for index in required[half:]:
+            w.write("{} >= 1.0 ; python_version >= '3'\n".format(package_name(index)))
+    return site_packages
+
+
+def best_of(repeat, function, *args, **kwargs):
+    """
+    Returns the fastest of repeat calls in seconds and the result of the last call.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def benchmark_environment(root, site_packages, repeat):
+    timings = {}
+    timings["read_installed"], (installed, _, graph) = best_of(
+        repeat, read_installed, False, use_cache=False, site_packages=[site_packages]
+    )
+    os.environ["XDG_CACHE_HOME"] = os.path.join(root, "cache")
+    read_installed(False, rebuild_cache=True, site_packages=[site_packages])
+    timings["read_installed_cached"], _ = best_of(repeat, read_installed, False, site_packages=[site_packages])
+    listings = {site_packages: list_path_item(site_packages)}
+    distributions = {path: read_distribution(path) for path in listings[site_packages][0]}
+    # the native backend's replacement for package_tree_to_name_tree, which only the pipdeptree backend still uses.
+    timings["build_graph"], _ = best_of(
+        repeat, build_installed_graph, [site_packages], listings, distributions, local_only=False
+    )
+    timings["read_requirements"], requirements = best_of(repeat, read_requirements, False, root=root)
+    extraneous = installed - requirements
+    timings["find_requirements_unique_to_projects"], _ = best_of(
+        repeat, find_requirements_unique_to_projects, graph, requirements, extraneous, set()
+    )
+    extraneous, uninstall = find_extraneous(installed, graph, requirements, set())
+    return {
+        "phases": timings,
+        "installed": len(graph),
+        "edges": graph.edge_count(),
+        "extraneous": len(extraneous),
+        "uninstall": len(uninstall),
+    }
+
+
+def run_benchmarks(sizes, repeat=3, fan_out=3, depth=4, cycles=None, editable=None, requirements=None, seed=0):
+    parameters = {
+        "sizes": sizes,
+        "repeat": repeat,
+        "fan_out": fan_out,
+        "depth": depth,
+        "cycles": cycles,
+        "editable": editable,
+        "requirements": requirements,
+        "seed": seed,
+    }
+    results = {}
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    try:
+        for size in sizes:
+            with TemporaryDirectory() as root:
+                site_packages = generate_environment(
+                    root,
+                    size,
+                    fan_out=fan_out,
+                    depth=depth,
+                    # by default one cycle and one editable install per hundred packages.
+                    cycles=size // 100 if cycles is None else cycles,
+                    editable=size // 100 if editable is None else editable,
+                    requirements=requirements,
+                    seed=seed,
+                )
+                results[str(size)] = benchmark_environment(root, site_packages, repeat)
+    finally:
+        if cache_home is None:
+            os.environ.pop("XDG_CACHE_HOME", None)
+        else:
+            os.environ["XDG_CACHE_HOME"] = cache_home
+    return {
+        "version": results_version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": parameters,
+        "results": results,
+    }
+
+
+def compare_results(baseline, current, threshold=1.25, min_difference=0.001):
+    """
+    Returns (size, phase, baseline seconds, current seconds) for each phase that got more than threshold times
+    slower, ignoring differences under min_difference seconds, which are mostly noise.
+    """
+    regressions = []
+    for size, result in sorted(current["results"].items(), key=lambda x: int(x[0])):
+        baseline_phases = baseline["results"].get(size, {}).get("phases", {})
+        for phase, seconds in result["phases"].items():
+            before = baseline_phases.get(phase)
+            if before is None:
+                continue
+            if seconds > before * threshold and seconds - before > min_difference:
+                regressions.append((size, phase, before, seconds))
+    return regressions
+
+
+def print_results(current, baseline=None):
+    for size, result in sorted(current["results"].items(), key=lambda x: int(x[0])):
+        print(
+            "{} packages, {} edges, {} extraneous, {} uninstalled:".format(
+                size, result["edges"], result["extraneous"], result["uninstall"]
+            )
+        )
+        baseline_phases = (baseline or {}).get("results", {}).get(size, {}).get("phases", {})
+        for phase, seconds in result["phases"].items():
+            line = "\t{:<40}{:>10.2f}ms".format(phase, seconds * 1000)
+            if phase in baseline_phases:
+                line += "{:>10.2f}ms {:>6.2f}x".format(
+                    baseline_phases[phase] * 1000, seconds / baseline_phases[phase] if baseline_phases[phase] else 0
+                )
+            print(line)
+
+
+def main(*args):
+    parser = argparse.ArgumentParser(
+        description="Times each phase of extraneous against generated environments of fake packages."
+    )
+    parser.add_argument(
+        "--sizes",
+        metavar="N",
+        type=int,
+        nargs="+",
+        default=default_sizes,
+        help="Numbers of packages to generate environments for.",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Times each phase is run, the fastest is kept.")
+    parser.add_argument("--fan-out", type=int, default=3, help="Requirements of each package on the next layer.")
+    parser.add_argument("--depth", type=int, default=4, help="Layers of packages requiring each other.")
+    parser.add_argument("--cycles", type=int, help="Requirements back to an earlier layer, one per 100 by default.")
+    parser.add_argument("--editable", type=int, help="Editable installs, one per 100 packages by default.")
+    parser.add_argument(
+        "--requirements", type=int, help="Names in the requirements files, half the top layer by default."
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated dependency graph.")
+    parser.add_argument("--output", "-o", metavar="path", help="Writes the results as JSON.")
+    parser.add_argument("--baseline", "-b", metavar="path", help="Compares against the JSON results of an earlier run.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.25,
+        help="Fails when a phase takes more than this many times as long as in the baseline.",
+    )
+    parsed_args = parser.parse_args(args or None)
+    current = run_benchmarks(
+        parsed_args.sizes,
+        repeat=parsed_args.repeat,
+        fan_out=parsed_args.fan_out,
+        depth=parsed_args.depth,
+        cycles=parsed_args.cycles,
+        editable=parsed_args.editable,
+        requirements=parsed_args.requirements,
+        seed=parsed_args.seed,
+    )
+    baseline = None
+    if parsed_args.baseline:
+        with open(parsed_args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(current, baseline)
+    if parsed_args.output:
+        with open(parsed_args.output, "w") as w:
+            json.dump(current, w, indent=2, sort_keys=True)
+    if baseline:
+        regressions = compare_results(baseline, current, threshold=parsed_args.threshold)
+        for size, phase, before, seconds in regressions:
+            print(
+                "regression: {} at {} packages took {:.2f}ms, {:.2f}ms in the baseline".format(
+                    phase, size, seconds * 1000, before * 1000
+                )
+            )
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
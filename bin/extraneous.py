@@ -0,0 +1,14 @@
+#!/bin/env python
+# Copyright (C) 2018 Arrai Innovations Inc. - All Rights Reserved
+import argparse
+import os
+import sys
+
+# the directory of a script comes first on sys.path, where this extraneous.py would shadow the extraneous package.
+if sys.path and os.path.isfile(os.path.join(sys.path[0] or os.curdir, "extraneous.py")):
+    del sys.path[0]
+
+from extraneous import cli  # noqa: E402
+
+cli.argparse_class = argparse.ArgumentParser
+cli.main()
@@ -1,2 +1,18 @@
 # Copyright (C) 2018 Arrai Innovations Inc. - All Rights Reserved
+import sys
+
+__all__ = ["Analyzer", "Environment"]
 __version__ = "2.0.5"
+
+if sys.version_info >= (3, 7):
+
+    def __getattr__(name):
+        # imported when first used, so the command line doesn't import the analysis for -h or bad arguments.
+        if name in __all__:
+            from extraneous import extraneous
+
+            return getattr(extraneous, name)
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+else:
+    from extraneous.extraneous import Analyzer, Environment  # noqa: F401
@@ -0,0 +1,266 @@
+# Copyright (C) 2018 Arrai Innovations Inc. - All Rights Reserved
+"""
+The extraneous.py command line. Only argparse is imported until the arguments are parsed, so -h and argument errors
+don't pay for importing and compiling the analysis in extraneous.extraneous.
+"""
+import argparse
+
+backends = ["native", "pipdeptree"]
+# directories --include-recursive never descends into, before the --ignore patterns.
+default_ignore = [".git/", ".hg/", ".svn/", ".tox/", ".nox/", "node_modules/", "__pycache__/"]
+default_not_extraneous = ["extraneous", "pipdeptree", "pip", "setuptools"]
+output_formats = ["text", "json", "ndjson"]
+timings_formats = ["text", "json"]
+
+
+def main(*args):
+    parser = argparse_class(
+        prog="extraneous.py",
+        description="Identifies packages that are installed but not defined in requirements files. Prints the"
+        " 'pip uninstall' command that removes these extraneous packages and any non-common"
+        " dependencies. Looks for packages matching '*requirements*.txt' in the current working"
+        " directory.",
+    )
+    parser.add_argument(
+        "--verbose", "-v", action="store_true", help="Prints installed site-package folders and requirements files."
+    )
+    parser.add_argument(
+        "--include",
+        "-i",
+        metavar="paths",
+        action="append",
+        help="Additional directories to look for '*requirements*.txt' files in.",
+    )
+    parser.add_argument(
+        "--include-recursive",
+        metavar="DIR",
+        action="append",
+        help="Directories to look for '*requirements*.txt' files in and under, such as the root of a monorepo."
+        " Virtual environments and {} aren't walked.".format(", ".join(x.rstrip("/") for x in default_ignore)),
+    )
+    parser.add_argument(
+        "--ignore",
+        metavar="pattern",
+        action="append",
+        default=[],
+        help="A .gitignore style pattern of paths under the --include-recursive directories to skip, such as 'build/'"
+        " or 'legacy/**/dev-requirements.txt'. Later patterns win, and '!pattern' brings paths back.",
+    )
+    parser.add_argument(
+        "--max-depth",
+        metavar="N",
+        type=int,
+        help="Descends at most N directories below the --include-recursive directories, 0 for only their own files.",
+    )
+    parser.add_argument(
+        "--exclude",
+        "-e",
+        metavar="names",
+        action="append",
+        default=[],
+        help="Package names to not consider extraneous."
+        " {} are not considered extraneous packages.".format(default_not_extraneous),
+    )
+    parser.add_argument(
+        "--full", "-f", action="store_true", help="Allows {} as extraneous packages.".format(default_not_extraneous)
+    )
+    parser.add_argument(
+        "--backend",
+        choices=backends,
+        default=backends[0],
+        help="How installed packages are read. 'native' reads the *.dist-info and *.egg-info metadata on sys.path"
+        " directly, 'pipdeptree' uses pip and pipdeptree.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Don't read or write the cache of installed packages, which is reused until site-packages changes.",
+    )
+    parser.add_argument(
+        "--rebuild-cache", action="store_true", help="Ignores the cache of installed packages and rewrites it."
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Runs a daemon that keeps the installed packages and requirements files in memory, updating them as they"
+        " change, and answers --client over a unix socket.",
+    )
+    parser.add_argument(
+        "--client",
+        action="store_true",
+        help="Asks the --serve daemon instead of reading installed packages, falling back to reading them when no"
+        " daemon is running.",
+    )
+    parser.add_argument("--socket", metavar="path", help="The unix socket of the daemon.")
+    parser.add_argument(
+        "--envs",
+        metavar="path",
+        help="Analyzes many environments in parallel, without running their python. Either a directory whose"
+        " subdirectories are environments with their own '*requirements*.txt' files, or a file listing"
+        " 'environment [requirements directory]' per line.",
+    )
+    parser.add_argument(
+        "--site-packages",
+        metavar="PATH",
+        action="append",
+        help="Looks for extraneous packages in another environment without running its python, reading the"
+        " site-packages directory PATH, or those of the environment rooted at PATH, along with the paths its *.pth"
+        " files list, its *.egg-link editable installs and zipped *.egg files. Can be given more than once.",
+    )
+    parser.add_argument(
+        "--io-workers",
+        metavar="N",
+        type=int,
+        default=1,
+        help="Reads installed package metadata on N threads, which helps when site-packages is on a network"
+        " filesystem.",
+    )
+    parser.add_argument(
+        "--format",
+        choices=output_formats,
+        default=output_formats[0],
+        help="'json' prints a JSON array and 'ndjson' a line of JSON per extraneous package as soon as it is known,"
+        " with its version, whether it's editable, the packages uninstalled along with it and the requirements files"
+        " read.",
+    )
+    parser.add_argument(
+        "--timings",
+        nargs="?",
+        const="text",
+        choices=timings_formats,
+        help="Prints the time taken by each phase, counts of what was read and the peak memory use to stderr, as text"
+        " by default or as json.",
+    )
+    parser.add_argument("--profile", metavar="path", help="Writes cProfile statistics of the run to path.")
+    parser.add_argument(
+        "--snapshot",
+        metavar="path",
+        help="Writes the installed packages, their versions and requirements to path as a compact binary snapshot"
+        " instead of looking for extraneous packages.",
+    )
+    parser.add_argument(
+        "--against", metavar="path", help="Looks for extraneous packages in a --snapshot instead of what's installed."
+    )
+    parser.add_argument(
+        "--diff",
+        metavar=("before", "after"),
+        nargs=2,
+        help="Prints the packages and requirements added, removed and changed between two --snapshot files.",
+    )
+    parser.add_argument(
+        "--image-tar",
+        metavar="path",
+        help="Looks for extraneous packages in the site-packages directories of a 'docker save' tarball instead of"
+        " what's installed, streaming its layers without extracting them. Reads the requirements files of the image's"
+        " working directory when none are found in the current working directory or --include.",
+    )
+    parser.add_argument(
+        "--installed-from",
+        metavar="path",
+        help="Looks for extraneous packages in a pip freeze output or lock file instead of what's installed, with"
+        " their requirements read from --metadata-from.",
+    )
+    parser.add_argument(
+        "--metadata-from",
+        metavar="path",
+        action="append",
+        help="Where --installed-from reads requirements: a wheelhouse directory of *.whl or *.whl.metadata files, or"
+        " a JSON file mapping names to versions to their Requires-Dist lines. Markers are evaluated for the running"
+        " interpreter. Can be given more than once, the first with a version wins.",
+    )
+    parser.add_argument(
+        "--why",
+        metavar="name",
+        help="Prints the shortest paths of requirements that keep the package name installed, from a requirements"
+        " file or a package that isn't extraneous, instead of looking for extraneous packages.",
+    )
+    parser.add_argument(
+        "--what-if",
+        metavar="names",
+        nargs="+",
+        help="Prints what uninstalling the packages names would remove along with them, were they dropped from the"
+        " requirements files, instead of looking for extraneous packages.",
+    )
+    parser.add_argument(
+        "--apply",
+        action="store_true",
+        help="Removes the extraneous packages and their dependencies, dependents first, by moving the files listed in"
+        " their RECORD to a stash directory in site-packages, each move written to its rollback.ndjson manifest"
+        " first. The packages of a batch are removed on --io-workers threads. Everything is restored when a removal"
+        " fails, or by --rollback when the run is killed, and the stash is deleted once all are removed.",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Prints the order --apply would remove packages in, without removing."
+    )
+    parser.add_argument(
+        "--sizes",
+        action="store_true",
+        help="Prints the bytes uninstalling each extraneous package and its dependencies frees, and the total, from"
+        " the sizes in their RECORD. Files a remaining package also lists aren't counted.",
+    )
+    parser.add_argument(
+        "--rank",
+        action="store_true",
+        help="Prints each package that no other package alone keeps installed, with the packages only it keeps"
+        " installed, most first, instead of looking for extraneous packages. With --sizes, the bytes each frees too.",
+    )
+    parser.add_argument(
+        "--orphans",
+        action="store_true",
+        help="Prints the files and directories in site-packages, or the --site-packages directories, that no"
+        " installed distribution lists in its RECORD or installed-files.txt, with their sizes, instead of looking"
+        " for extraneous packages. The manifests are read on --io-workers threads.",
+    )
+    parser.add_argument(
+        "--rollback",
+        metavar="path",
+        help="Restores the packages of an --apply that was killed midway from its rollback.ndjson manifest.",
+    )
+    if args:
+        parsed_args = parser.parse_args(args)
+    else:
+        parsed_args = parser.parse_args()
+    other_sources = [
+        parsed_args.against,
+        parsed_args.installed_from,
+        parsed_args.image_tar,
+        parsed_args.envs,
+        parsed_args.site_packages,
+    ]
+    if (parsed_args.apply or parsed_args.dry_run) and any(other_sources + [parsed_args.client, parsed_args.serve]):
+        parser.error("--apply and --dry-run only remove packages installed for the running interpreter.")
+    if parsed_args.sizes and any(other_sources[:4] + [parsed_args.client]):
+        parser.error("--sizes only measures packages installed for the running interpreter or in --site-packages.")
+    if parsed_args.rank and (parsed_args.envs or parsed_args.client):
+        parser.error("--rank can't be used with --envs or --client.")
+    # the analysis is only imported once the arguments are good.
+    from extraneous.extraneous import run, timer
+
+    if parsed_args.timings:
+        timer.start()
+    profiler = None
+    if parsed_args.profile:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        return run(parsed_args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(parsed_args.profile)
+        if parsed_args.timings:
+            timer.report(parsed_args.timings)
+
+
+class BadArgumentError(ValueError):
+    pass
+
+
+class NoExitArgumentParser(argparse.ArgumentParser):
+    def error(self, message):
+        raise BadArgumentError(self.format_usage(), message)
+
+
+argparse_class = NoExitArgumentParser
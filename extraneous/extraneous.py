@@ -1,26 +1,124 @@
-#!/bin/env python
 # Copyright (C) 2018 Arrai Innovations Inc. - All Rights Reserved
-import argparse
 import glob
+import hashlib
+import json
 import os
+import posixpath
 import re
+import sys
+import time
+from array import array
+from collections import namedtuple
+from contextlib import contextmanager, redirect_stdout
 from itertools import chain
 
-# noinspection PyUnresolvedReferences,PyPackageRequirements
-from colors import color
-from pipdeptree import PackageDAG
-
-try:
-    # noinspection PyPackageRequirements,PyCompatibility
-    from pip._internal.utils.misc import get_installed_distributions
-    from pip._internal.utils.misc import dist_is_editable
-except ImportError:
-    # noinspection PyPackageRequirements,PyCompatibility
-    from pip import get_installed_distributions
-    from pip import dist_is_editable
+from extraneous.cli import default_ignore, default_not_extraneous
 
 flatten = chain.from_iterable
-re_operator = re.compile(r"[>=]")
+re_requirement = re.compile(r"^\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[[^\]]*\])?(.*)$")
+re_comment = re.compile(r"(^|\s+)#.*$")
+re_egg_fragment = re.compile(r"#egg=([^&\s]+)")
+re_marker_extra = re.compile(r"""\bextra\s*==\s*['"]([^'"]*)['"]|['"]([^'"]*)['"]\s*==\s*extra\b""")
+re_python_version = re.compile(r"python(\d+\.\d+)")
+# pip freeze names editable installs of paths in a comment before them.
+re_freeze_editable = re.compile(r"^#\s*Editable .*\(([^()=\s]+)==([^()\s]+)\)\s*$")
+# the members of an image layer under a site-packages directory, split into that directory, entry and file.
+re_image_member = re.compile(r"^((?:.*/)?(?:site|dist)-packages)/([^/]+)(?:/([^/]+))?$")
+# the names glob("*requirements*.txt") matches, which skips hidden files.
+re_requirements_file = re.compile(r"^(?!\.).*requirements.*\.txt$")
+re_option = re.compile(r"^(--requirement|--constraint|--editable|-r|-c|-e)(?:\s*=\s*|\s+|(?=[^\s=-]))(\S.*)$")
+# pip's stdlib_pkgs, which get_installed_distributions skips by default.
+stdlib_packages = {"python", "wsgiref", "argparse"}
+# bump when the cache file layout changes, older cache files are then ignored.
+cache_version = 4
+snapshot_magic = b"EXTRSNAP"
+# bump when the snapshot layout changes.
+snapshot_version = 1
+# magic, version, node count, edge count and the sizes of the info, names, versions and extras sections.
+snapshot_header = "<8sIIIIIII"
+snapshot_installed = 1
+snapshot_editable = 2
+# what site-packages holds outside of any RECORD: the metadata of distributions, editable and egg installs.
+unrecorded_suffixes = (".dist-info", ".egg-info", ".egg-link", ".egg")
+unrecorded_names = {"easy-install.pth"}
+
+
+class PhaseTimer(object):
+    """
+    Records the wall time of nested phases, named counters and the tracemalloc peak of a run for --timings. A phase
+    entered more than once, like parsing each requirements file, adds up. Nothing is recorded until started, so the
+    instrumentation costs next to nothing otherwise.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.phases = {}
+        self.counters = {}
+        self.stack = []
+        self.started = None
+
+    def start(self):
+        import tracemalloc
+
+        tracemalloc.start()
+        self.enabled = True
+        self.phases = {}
+        self.counters = {}
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        self.stack.append(name)
+        # [depth, seconds, calls], in the order phases were first entered.
+        record = self.phases.setdefault(".".join(self.stack), [len(self.stack) - 1, 0.0, 0])
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            record[1] += time.perf_counter() - started
+            record[2] += 1
+            self.stack.pop()
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def results(self):
+        import tracemalloc
+
+        _, peak = tracemalloc.get_traced_memory()
+        return {
+            "total": time.perf_counter() - self.started,
+            "phases": [
+                {"name": name, "seconds": seconds, "calls": calls} for name, (_, seconds, calls) in self.phases.items()
+            ],
+            "counters": self.counters,
+            "peak_memory": peak,
+        }
+
+    def report(self, output_format="text", stream=None):
+        results = self.results()
+        stream = stream or sys.stderr
+        if output_format == "json":
+            stream.write(json.dumps(results) + "\n")
+            return
+        lines = ["timings:"]
+        for name, (depth, seconds, calls) in self.phases.items():
+            label = "    " * (depth + 1) + name.rsplit(".", 1)[-1]
+            if calls > 1:
+                label += " ({})".format(calls)
+            lines.append("{:<40}{:>10.2f}ms".format(label, seconds * 1000))
+        lines.append("{:<40}{:>10.2f}ms".format("    total", results["total"] * 1000))
+        lines.append("counters:")
+        lines.extend("\t{}: {}".format(name, value) for name, value in sorted(self.counters.items()))
+        lines.append("peak memory: {:.1f}KiB".format(results["peak_memory"] / 1024))
+        stream.write("\n".join(lines) + "\n")
+
+
+timer = PhaseTimer()
 
 
 def normalize_package_name(name):
@@ -30,155 +128,3252 @@ def normalize_package_name(name):
     return re.sub(r"[-_.]+", "-", name).lower()
 
 
-def parse_requirement(line):
-    if line.startswith("-e"):
-        return line
-    return re_operator.split(line)[0]
+RequirementLine = namedtuple(
+    "RequirementLine", ["name", "extras", "specifier", "marker", "editable", "constraint", "path", "line_number"]
+)
 
 
-def read_requirements(verbose=True, include=None):
-    cwd = os.getcwd()
-    if verbose:
-        print("reading requirements from:")
-    include_files = sorted(glob.glob("*requirements*.txt"))
+def find_requirement_files(include=None, root=None):
+    include_files = sorted(glob.glob(os.path.join(root, "*requirements*.txt") if root else "*requirements*.txt"))
     if include:
         for include_dir in include:
             include_files += sorted(glob.glob(os.path.join(include_dir, "*requirements*.txt")))
-    reqs = set()
-    for rname in include_files:
-        if os.path.isabs(rname):
-            path = rname
+    return include_files
+
+
+def compile_ignore_pattern(pattern):
+    """
+    Returns (regex, negated, directories only) for a .gitignore style pattern, matched against '/' separated paths
+    relative to the directory walked. Patterns without a '/' but a trailing one match at any depth.
+    """
+    negated = pattern.startswith("!")
+    if negated:
+        pattern = pattern[1:]
+    directories_only = pattern.endswith("/")
+    pattern = pattern.rstrip("/")
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    regex = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i) and i + 2 == len(pattern):
+            regex.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            regex.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            regex.append("[^/]")
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 2 :]:
+            end = pattern.index("]", i + 2)
+            characters = pattern[i + 1 : end]
+            if characters.startswith("!"):
+                characters = "^" + characters[1:]
+            regex.append("[{}]".format(characters.replace("\\", "\\\\")))
+            i = end + 1
         else:
-            path = os.path.relpath(rname, cwd)
+            regex.append(re.escape(pattern[i]))
+            i += 1
+    return re.compile("^{}{}$".format("" if anchored else "(?:.*/)?", "".join(regex))), negated, directories_only
+
+
+def is_ignored(path, is_dir, patterns):
+    """
+    Returns whether the last of patterns matching path ignores it, like git does.
+    """
+    ignored = False
+    for regex, negated, directories_only in patterns:
+        if (is_dir or not directories_only) and regex.match(path):
+            ignored = not negated
+    return ignored
+
+
+def walk_requirement_files(directory, ignore=(), max_depth=None):
+    """
+    Yields the '*requirements*.txt' files under directory as they are found, in a single os.scandir() walk that
+    doesn't descend into directories ignored by the .gitignore style ignore patterns, deeper than max_depth or holding
+    a virtual environment. Symlinked directories aren't followed, so the walk can't loop.
+    """
+    patterns = [compile_ignore_pattern(x) for x in chain(default_ignore, ignore)]
+    stack = [("", 0)]
+    while stack:
+        relative, depth = stack.pop()
         try:
-            with open(path) as rfile:
-                if verbose:
-                    print("\t{}".format(path))
-                reqs |= {parse_requirement(line) for line in rfile.read().split("\n") if line}
-        except FileNotFoundError:
-            if verbose:
-                print("\t{} (Not Found)".format(path))
-    if not reqs:
-        raise ValueError("No requirements found.{}".format("" if verbose else " Use -v for more information."))
-    return {normalize_package_name(x) for x in reqs}
+            with os.scandir(os.path.join(directory, relative)) as entries:
+                entries = sorted(entries, key=lambda x: x.name)
+        except OSError:
+            continue
+        timer.count("directories walked")
+        if relative and any(x.name == "pyvenv.cfg" for x in entries):
+            continue
+        subdirectories = []
+        for entry in entries:
+            path = "{}/{}".format(relative, entry.name) if relative else entry.name
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                continue
+            if is_ignored(path, is_dir, patterns):
+                continue
+            if is_dir:
+                if max_depth is None or depth < max_depth:
+                    subdirectories.append((path, depth + 1))
+            elif re_requirements_file.match(entry.name):
+                yield os.path.join(directory, relative, entry.name)
+        stack.extend(reversed(subdirectories))
+
+
+def iter_logical_lines(rfile):
+    """
+    Yields (line number, line) for each line of a requirements file with backslash continuations joined and comments
+    removed, like pip.
+    """
+    parts = []
+    line_number = 0
+    for number, line in enumerate(rfile, 1):
+        line = line.rstrip("\r\n")
+        if not parts:
+            line_number = number
+        if line.endswith("\\") and not re_comment.match(line):
+            parts.append(line[:-1])
+            continue
+        parts.append(line)
+        line = re_comment.sub("", "".join(parts)).strip()
+        parts = []
+        if line:
+            yield line_number, line
+    line = re_comment.sub("", "".join(parts)).strip()
+    if line:
+        yield line_number, line
+
+
+def strip_options(line):
+    """
+    Drops per-requirement options, like --hash, which follow the requirement itself.
+    """
+    args = []
+    for token in line.split(" "):
+        if token.startswith("-"):
+            break
+        args.append(token)
+    return " ".join(args).strip()
+
+
+def parse_requirement_spec(spec, editable=False):
+    """
+    Returns the normalized name, extras, specifier and marker of a requirement line. The name is None for urls and
+    paths without an #egg= fragment.
+    """
+    spec, _, marker = spec.partition(";")
+    marker = marker.strip() or None
+    egg = re_egg_fragment.search(spec)
+    match = re_requirement.match(spec)
+    if egg:
+        match = re_requirement.match(egg.group(1))
+        specifier = spec.strip()
+    elif match and match.group(3).strip().startswith("@"):
+        # name @ url
+        specifier = match.group(3).strip()
+    elif editable or "://" in spec or spec.startswith((".", "/", "~")):
+        basename = os.path.basename(spec.strip().split("#")[0])
+        # wheel file names start with the distribution name.
+        match = re_requirement.match(basename.split("-")[0]) if basename.endswith(".whl") else None
+        specifier = spec.strip()
+    else:
+        specifier = match.group(3).strip() if match else spec.strip()
+    if not match:
+        return None, (), specifier, marker
+    extras = tuple(
+        sorted({normalize_package_name(x.strip()) for x in (match.group(2) or "").strip("[]").split(",") if x.strip()})
+    )
+    return normalize_package_name(match.group(1)), extras, specifier, marker
+
+
+def iter_requirements(path, constraint=False, seen=None, files=None):
+    """
+    Streams the RequirementLine records of a pip requirements file, following its -r and -c references relative to
+    the file. Each file is read once per seen set, which also breaks reference cycles. files collects each file as a
+    (path, found) pair.
+    """
+    if seen is None:
+        seen = set()
+    key = (os.path.realpath(path), constraint)
+    if key in seen:
+        return
+    seen.add(key)
+    try:
+        rfile = open(path)
+    except FileNotFoundError:
+        if files is not None:
+            files.append((path, False))
+        return
+    if files is not None:
+        files.append((path, True))
+    with rfile:
+        for line_number, line in iter_logical_lines(rfile):
+            option = re_option.match(line)
+            if option:
+                flag, value = option.groups()
+                value = strip_options(value)
+                if flag in ("-e", "--editable"):
+                    yield RequirementLine(
+                        *parse_requirement_spec(value, editable=True),
+                        editable=True,
+                        constraint=constraint,
+                        path=path,
+                        line_number=line_number,
+                    )
+                else:
+                    included = os.path.join(os.path.dirname(path), os.path.expanduser(value))
+                    yield from iter_requirements(
+                        included, constraint or flag in ("-c", "--constraint"), seen=seen, files=files
+                    )
+                continue
+            if line.startswith("-"):
+                # global options like --index-url or --require-hashes.
+                continue
+            yield RequirementLine(
+                *parse_requirement_spec(strip_options(line)),
+                editable=False,
+                constraint=constraint,
+                path=path,
+                line_number=line_number,
+            )
+
 
+def read_requirement_file(path, seen=None, markers=None):
+    """
+    Returns the names required by path, including None for unnamed urls and paths, the files read for it as
+    (path, found) pairs and the extras requested as (name, extra) pairs. Constraints and requirements whose
+    environment marker doesn't apply aren't required.
+    """
+    markers = markers or running_markers
+    files = []
+    names = set()
+    extras = set()
+    for requirement in iter_requirements(path, seen=seen, files=files):
+        timer.count("requirement lines")
+        if requirement.constraint or (requirement.marker and not markers.applies(requirement.marker)):
+            continue
+        names.add(requirement.name)
+        if requirement.name:
+            extras.update((requirement.name, extra) for extra in requirement.extras)
+    return names, files, extras
+
+
+def no_requirements_message(verbose):
+    return "No requirements found.{}".format("" if verbose else " Use -v for more information.")
 
-def read_installed(verbose=True):
+
+def read_requirements(
+    verbose=True,
+    include=None,
+    root=None,
+    files=None,
+    extras=None,
+    markers=None,
+    include_recursive=None,
+    ignore=(),
+    max_depth=None,
+    io_workers=1,
+    cache=None,
+):
+    """
+    Returns the names required by the requirements files found in root, the current working directory by default,
+    the include directories and anywhere under the include_recursive directories, see walk_requirement_files(). files
+    collects each file read as a (path, found) pair and extras each extra requested as a (name, extra) pair. Markers
+    are evaluated by markers, against the running interpreter by default. With more than one io_workers the files are
+    read on threads as the walk finds them. cache keeps the read_requirement_file() result of each absolute path
+    across calls.
+    """
     cwd = os.getcwd()
     if verbose:
+        print("reading requirements from:")
+    reqs = set()
+    # shared between the files read on one thread, so each included file is only read once.
+    seen = set() if io_workers <= 1 and cache is None else None
+    with timer.phase("find files"):
+        requirement_files = find_requirement_files(include, root)
+    requirement_files = chain(
+        requirement_files,
+        flatten(walk_requirement_files(x, ignore, max_depth) for x in include_recursive or ()),
+    )
+
+    def read(rname):
+        path = rname if os.path.isabs(rname) else os.path.relpath(rname, cwd)
+        if cache is None:
+            return read_requirement_file(path, seen=seen, markers=markers)
+        key = os.path.abspath(path)
+        if key not in cache:
+            cache[key] = read_requirement_file(path, markers=markers)
+        return cache[key]
+
+    with timer.phase("parse"):
+        results = map_io(read, requirement_files, io_workers)
+    read_paths = set()
+    for names, read_files, read_extras in results:
+        if seen is None:
+            # files read on other threads or cached don't share seen, drop those an earlier file already included.
+            read_files = [x for x in read_files if os.path.realpath(x[0]) not in read_paths]
+            read_paths.update(os.path.realpath(x[0]) for x in read_files)
+        timer.count("requirement files", len(read_files))
+        if files is not None:
+            files.extend(read_files)
+        if extras is not None:
+            extras.update(read_extras)
+        reqs |= names
+        if verbose:
+            for file_path, found in read_files:
+                print("\t{}{}".format(file_path, "" if found else " (Not Found)"))
+    # unnamed requirements, like -e . or a path, don't count.
+    reqs.discard(None)
+    if not reqs:
+        raise ValueError(no_requirements_message(verbose))
+    return reqs
+
+
+def parse_requires_txt(text):
+    """
+    Converts an egg-info requires.txt into Requires-Dist style lines, folding section headers into markers.
+    """
+    requires = []
+    marker = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("[") and line.endswith("]"):
+            extra, _, section_marker = line[1:-1].partition(":")
+            markers = []
+            if section_marker:
+                markers.append("({})".format(section_marker))
+            if extra:
+                markers.append('extra == "{}"'.format(extra))
+            marker = " and ".join(markers) or None
+            continue
+        requires.append("{} ; {}".format(line, marker) if marker else line)
+    return requires
+
+
+def read_headers(metadata_file, fields):
+    """
+    Reads the RFC 822 header block of a METADATA or PKG-INFO file line by line, stopping at the blank line before the
+    long description, which can be hundreds of KB. Returns the values of each of the lower case fields present.
+    """
+    headers = {}
+    values = None
+    for line in metadata_file:
+        if line[:1] in (" ", "\t"):
+            # a folded continuation of the previous header.
+            if values:
+                values[-1] = "{} {}".format(values[-1], line.strip())
+            continue
+        name, colon, value = line.rstrip("\r\n").partition(":")
+        if not colon:
+            # the blank line ending the headers, or the start of a body without one.
+            break
+        name = name.strip().lower()
+        values = headers.setdefault(name, []) if name in fields else None
+        if values is not None:
+            values.append(value.strip())
+    return headers
+
+
+def read_distribution(path):
+    """
+    Reads the name, version and requirements of the *.dist-info, *.egg-info or *.egg/EGG-INFO at path.
+    """
+    if os.path.basename(path) == "EGG-INFO" and os.path.isfile(os.path.dirname(path)):
+        return read_zipped_egg(os.path.dirname(path))
+    if path.endswith(".dist-info"):
+        metadata_path = os.path.join(path, "METADATA")
+    elif os.path.isdir(path):
+        metadata_path = os.path.join(path, "PKG-INFO")
+    else:
+        # distutils writes a single PKG-INFO style file named *.egg-info.
+        metadata_path = path
+    try:
+        with open(metadata_path, encoding="utf-8", errors="surrogateescape") as metadata_file:
+            metadata = read_headers(metadata_file, ("name", "version", "requires-dist"))
+    except OSError:
+        return None
+    requires = None
+    if not path.endswith(".dist-info"):
         try:
-            # virtual environment with venv in python 3.3+
-            from site import getsitepackages
+            with open(os.path.join(path, "requires.txt"), encoding="utf-8") as requires_file:
+                requires = parse_requires_txt(requires_file.read())
+        except OSError:
+            requires = []
+    return metadata_distribution(path, metadata, requires)
+
+
+def read_zipped_egg(path):
+    """
+    Reads the name, version and requirements of a zipped *.egg from its EGG-INFO, without extracting the archive.
+    """
+    import io
+    import zipfile
+
+    try:
+        with zipfile.ZipFile(path) as egg:
+            with egg.open("EGG-INFO/PKG-INFO") as metadata_file:
+                metadata = read_headers(
+                    io.TextIOWrapper(metadata_file, encoding="utf-8", errors="surrogateescape"), ("name", "version")
+                )
+            try:
+                requires = parse_requires_txt(egg.read("EGG-INFO/requires.txt").decode("utf-8"))
+            except KeyError:
+                requires = []
+    except (OSError, KeyError, zipfile.BadZipFile):
+        return None
+    return metadata_distribution(path, metadata, requires)
+
+
+def metadata_distribution(path, metadata, requires=None):
+    """
+    Returns the name, version and requirements of the distribution at path from its read_headers() metadata. requires
+    are the requirements of an egg-info, read from its requires.txt instead of the metadata.
+    """
+    name = (metadata.get("name") or [None])[0] or os.path.basename(path).split("-")[0]
+    version = (metadata.get("version") or [None])[0]
+    if requires is None:
+        requires = metadata.get("requires-dist", [])
+    return name, version, requires
+
+
+class MarkerEvaluator(object):
+    """
+    Evaluates environment markers against the running interpreter, with the values in environment overriding its own.
+    Each distinct marker and extra is only evaluated once, as thousands of requirements share a handful of markers.
+    """
+
+    def __init__(self, environment=None):
+        self.environment = environment or {}
+        self.results = {}
 
-            site_package_dirs = getsitepackages()
+    def applies(self, marker, extra=""):
+        key = (marker, extra)
+        result = self.results.get(key)
+        if result is None:
+            timer.count("markers evaluated")
+            result = self.results[key] = self.evaluate(marker, extra)
+        return result
+
+    def evaluate(self, marker, extra):
+        try:
+            # noinspection PyPackageRequirements
+            from packaging.markers import InvalidMarker, Marker
         except ImportError:
-            # virtual environment with virtualenv
-            # https://github.com/pypa/virtualenv/issues/228
-            from distutils.sysconfig import get_python_lib
+            # noinspection PyPackageRequirements,PyProtectedMember
+            from pip._vendor.packaging.markers import InvalidMarker, Marker
+        try:
+            return Marker(marker).evaluate(dict(self.environment, extra=extra))
+        except InvalidMarker:
+            return False
 
-            site_package_dirs = [get_python_lib()]
-        print("reading installed from:\n\t{}".format("\n\t".join([os.path.relpath(x, cwd) for x in site_package_dirs])))
-    pkgs = get_installed_distributions()
-    tree = PackageDAG.from_pkgs(pkgs)
-    branch_keys = {r.key for r in flatten(tree.values())}
-    nodes = [p for p in tree.keys() if p.key not in branch_keys]
-    project_names = {normalize_package_name(p.project_name) for p in nodes}
-    editable_packages = {normalize_package_name(p.project_name) for p in nodes if dist_is_editable(p._obj)}
-    return set(project_names), editable_packages, tree
 
+running_markers = MarkerEvaluator()
 
-def package_tree_to_name_tree(tree):
-    return {
-        normalize_package_name(k.project_name): {normalize_package_name(i.project_name) for i in v}
-        for k, v in tree.items()
-    }
 
+def target_marker_environment(site_packages):
+    """
+    The marker values of another environment that can be told without running its python: python_version from a
+    lib/pythonX.Y/site-packages path and python_full_version from the pyvenv.cfg of a venv.
+    """
+    environment = {}
+    for path in site_packages:
+        match = re_python_version.search(path.replace(os.sep, "/").rsplit("/site-packages", 1)[0])
+        if not match:
+            continue
+        environment["python_version"] = match.group(1)
+        try:
+            with open(os.path.join(path, os.pardir, os.pardir, os.pardir, "pyvenv.cfg")) as cfg:
+                for line in cfg:
+                    key, _, value = line.partition("=")
+                    value = value.strip()
+                    if key.strip() in ("version", "version_info") and value.startswith(match.group(1) + "."):
+                        environment["python_full_version"] = value
+        except OSError:
+            pass
+        break
+    return environment
 
-def find_requirements_unique_to_projects(tree, requirements, root_package_names_to_uninstall, exclude_packages):
-    name_tree = package_tree_to_name_tree(tree)
-    name_rtree = package_tree_to_name_tree(tree.reverse())
-    packages_to_uninstall = set(root_package_names_to_uninstall)
 
-    def add_to_uninstall(packages):
-        for package in packages:
-            if package in requirements or package in exclude_packages:
-                continue
-            required_by = name_rtree.get(package, set())
-            other_required_by = required_by - packages_to_uninstall
-            if not other_required_by:
-                packages_to_uninstall.add(package)
-                p_requirements = name_tree.get(package, None)
-                if p_requirements:
-                    add_to_uninstall(p_requirements)
+def parse_requires_dist(requirement):
+    """
+    Returns the normalized name, extras and marker of a Requires-Dist line, or None when it has no name.
+    """
+    requirement, _, marker = requirement.partition(";")
+    match = re_requirement.match(requirement)
+    if not match:
+        return None
+    extras = tuple(
+        sorted({normalize_package_name(x.strip()) for x in (match.group(2) or "").strip("[]").split(",") if x.strip()})
+    )
+    return normalize_package_name(match.group(1)), extras, marker.strip() or None
 
-    add_to_uninstall(root_package_names_to_uninstall)
-    return packages_to_uninstall
+
+def marker_extras(marker):
+    """
+    The extras a marker can be true for, as written in the marker.
+    """
+    return {a or b for a, b in re_marker_extra.findall(marker)}
+
+
+def is_editable_direct_url(path):
+    try:
+        with open(os.path.join(path, "direct_url.json")) as direct_url_file:
+            direct_url = json.load(direct_url_file)
+    except (OSError, ValueError):
+        return False
+    return is_editable_direct_url_json(direct_url)
+
+
+def is_editable_direct_url_json(direct_url):
+    return isinstance(direct_url, dict) and bool(direct_url.get("dir_info", {}).get("editable"))
 
 
-def main(*args):
-    default_not_extraneous = ["extraneous", "pipdeptree", "pip", "setuptools"]
-    parser = argparse_class(
-        prog="extraneous.py",
-        description="Identifies packages that are installed but not defined in requirements files. Prints the"
-        " 'pip uninstall' command that removes these extraneous packages and any non-common"
-        " dependencies. Looks for packages matching '*requirements*.txt' in the current working"
-        " directory.",
+def is_local(path):
+    """
+    Matches pip: everything is local outside of a virtual environment, otherwise only paths within sys.prefix.
+    """
+    if getattr(sys, "base_prefix", sys.prefix) == sys.prefix and not hasattr(sys, "real_prefix"):
+        return True
+    return os.path.normcase(os.path.realpath(path)).startswith(os.path.normcase(os.path.realpath(sys.prefix)))
+
+
+def list_path_item(path_item):
+    """
+    Returns the *.dist-info and *.egg-info paths in path_item and the names of its *.egg-link files. An *.egg on the
+    path, a directory or a zip file, has its metadata in EGG-INFO instead.
+    """
+    if path_item.endswith(".egg"):
+        return ([os.path.join(path_item, "EGG-INFO")] if os.path.exists(path_item) else []), set()
+    try:
+        entries = sorted(os.listdir(path_item))
+    except OSError:
+        return [], set()
+    return (
+        [os.path.join(path_item, x) for x in entries if x.endswith((".dist-info", ".egg-info"))],
+        {x[: -len(".egg-link")] for x in entries if x.endswith(".egg-link")},
     )
-    parser.add_argument(
-        "--verbose", "-v", action="store_true", help="Prints installed site-package folders and requirements files."
+
+
+def read_pth_file(path):
+    """
+    Returns the paths a *.pth file lists, relative to its directory. Lines starting with import are code only the
+    environment's python can run, and are skipped.
+    """
+    paths = []
+    try:
+        with open(path, encoding="utf-8", errors="surrogateescape") as pth_file:
+            for line in pth_file:
+                line = line.rstrip()
+                if not line or line.startswith(("#", "import ", "import\t")):
+                    continue
+                paths.append(os.path.join(os.path.dirname(path), line))
+    except OSError:
+        pass
+    return paths
+
+
+def read_egg_link(path):
+    """
+    Returns the project directory an *.egg-link file points to, or None.
+    """
+    try:
+        with open(path, encoding="utf-8", errors="surrogateescape") as egg_link_file:
+            target = egg_link_file.readline().strip()
+    except OSError:
+        return None
+    return os.path.join(os.path.dirname(path), target) if target else None
+
+
+def site_path_items(site_packages):
+    """
+    Returns the sys.path entries the python of another environment would have from its site_packages, like
+    site.addsitedir() without running anything: each directory followed by the existing paths its *.pth files list,
+    in name order, then the projects of *.egg-link editable installs that no *.pth file listed.
+    """
+    path_items = []
+    known = set()
+    egg_links = []
+
+    def add(path, check=True):
+        key = os.path.normcase(os.path.abspath(path))
+        if key not in known and (not check or os.path.exists(path)):
+            known.add(key)
+            path_items.append(path)
+
+    for site_dir in site_packages:
+        add(site_dir, check=False)
+        try:
+            entries = sorted(os.listdir(site_dir))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.endswith(".pth"):
+                for path in read_pth_file(os.path.join(site_dir, entry)):
+                    add(path)
+            elif entry.endswith(".egg-link"):
+                egg_links.append(os.path.join(site_dir, entry))
+    for egg_link in egg_links:
+        target = read_egg_link(egg_link)
+        if target:
+            add(target)
+    return path_items
+
+
+def distribution_mtime(path):
+    """
+    The latest mtime of the metadata at path and the files its requirements are read from.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    if path.endswith((".dist-info", ".egg-info")) and os.path.isdir(path):
+        # rewriting a file in place, as egg_info does for editable installs, leaves the directory's mtime alone.
+        for file_name in ["METADATA"] if path.endswith(".dist-info") else ["PKG-INFO", "requires.txt"]:
+            try:
+                mtime = max(mtime, os.stat(os.path.join(path, file_name)).st_mtime_ns)
+            except FileNotFoundError:
+                pass
+    return mtime
+
+
+class PackageNode(object):
+    __slots__ = ("name", "version", "editable", "installed")
+
+    def __init__(self, name, version=None, editable=False, installed=False):
+        self.name = name
+        self.version = version
+        self.editable = editable
+        self.installed = installed
+
+    def __repr__(self):
+        return "PackageNode({!r}, {!r})".format(self.name, self.version)
+
+
+def transpose_adjacency(node_count, offsets, targets):
+    reverse_offsets = array("i", [0]) * (node_count + 1)
+    for target in targets:
+        reverse_offsets[target + 1] += 1
+    for node_id in range(node_count):
+        reverse_offsets[node_id + 1] += reverse_offsets[node_id]
+    positions = reverse_offsets[:-1]
+    reverse_targets = array("i", [0]) * len(targets)
+    for source in range(node_count):
+        for position in range(offsets[source], offsets[source + 1]):
+            target = targets[position]
+            reverse_targets[positions[target]] = source
+            positions[target] += 1
+    return reverse_offsets, reverse_targets
+
+
+class PackageGraph(object):
+    """
+    The dependency graph shared by the whole analysis. Package names are interned and mapped to integer ids, and the
+    requirements (forward) and required by (reverse) edges are kept in CSR form: the edges of node i are
+    targets[offsets[i]:offsets[i + 1]].
+
+    A requirement on package[extra] is an edge to the package and to each requirement of its extra. extras maps the
+    node ids of packages with extras to the node ids each extra requires, for extras requested by requirements files.
+    """
+
+    __slots__ = ("nodes", "ids", "offsets", "targets", "reverse_offsets", "reverse_targets", "extras")
+
+    def __init__(self, nodes, offsets, targets, extras=None, reverse=None):
+        self.nodes = nodes
+        self.ids = {node.name: node_id for node_id, node in enumerate(nodes)}
+        self.offsets = offsets
+        self.targets = targets
+        self.extras = extras or {}
+        if reverse is None:
+            with timer.phase("reverse graph"):
+                reverse = transpose_adjacency(len(nodes), offsets, targets)
+        self.reverse_offsets, self.reverse_targets = reverse
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @classmethod
+    def from_name_tree(cls, name_tree, editable_packages=(), versions=None):
+        builder = PackageGraphBuilder()
+        for name, requirements in name_tree.items():
+            node_id = builder.add_package(name, (versions or {}).get(name), name in editable_packages)
+            for requirement in requirements:
+                builder.add_requirement(node_id, requirement)
+        return builder.build()
+
+    def requirements(self, node_id):
+        return self.targets[self.offsets[node_id] : self.offsets[node_id + 1]]
+
+    def required_by(self, node_id):
+        return self.reverse_targets[self.reverse_offsets[node_id] : self.reverse_offsets[node_id + 1]]
+
+    def edge_count(self):
+        return len(self.targets)
+
+    def top_level_names(self):
+        return {
+            node.name
+            for node_id, node in enumerate(self.nodes)
+            if node.installed and self.reverse_offsets[node_id] == self.reverse_offsets[node_id + 1]
+        }
+
+    def editable_names(self):
+        return {node.name for node in self.nodes if node.editable}
+
+    def extra_requirements(self, extras):
+        """
+        Returns the names required by the (name, extra) pairs of extras.
+        """
+        names = set()
+        for name, extra in extras:
+            node_id = self.ids.get(name)
+            if node_id is not None:
+                names.update(self.nodes[x].name for x in self.extras.get(node_id, {}).get(extra, ()))
+        return names
+
+
+class PackageGraphBuilder(object):
+    def __init__(self):
+        self.nodes = []
+        self.ids = {}
+        self.requirements = []
+        # (node id, requirement id) to the extras requested of the requirement.
+        self.requirement_extras = {}
+        # node id to {extra: [(requirement id, extras)]} for requirements only needed by an extra.
+        self.extra_requirements = {}
+
+    def intern(self, name):
+        node_id = self.ids.get(name)
+        if node_id is None:
+            node_id = self.ids[name] = len(self.nodes)
+            self.nodes.append(PackageNode(sys.intern(name)))
+            self.requirements.append([])
+        return node_id
+
+    def is_installed(self, name):
+        node_id = self.ids.get(name)
+        return node_id is not None and self.nodes[node_id].installed
+
+    def add_package(self, name, version, editable=False):
+        node_id = self.intern(name)
+        node = self.nodes[node_id]
+        node.version = version
+        node.editable = editable
+        node.installed = True
+        return node_id
+
+    def add_requirement(self, node_id, requirement, extras=(), extra=None):
+        """
+        Adds requirement[extras] as a requirement of node_id, or of its extra when given.
+        """
+        requirement_id = self.intern(requirement)
+        if extra is not None:
+            self.extra_requirements.setdefault(node_id, {}).setdefault(extra, []).append((requirement_id, extras))
+            return
+        if requirement_id not in self.requirements[node_id]:
+            self.requirements[node_id].append(requirement_id)
+        if extras:
+            self.requirement_extras.setdefault((node_id, requirement_id), set()).update(extras)
+
+    def expand_extras(self, node_id, requirements):
+        """
+        Returns the ids required by (requirement id, extras) pairs, following the requirements of extras transitively.
+        """
+        expanded = []
+        seen = {node_id}
+        seen_extras = set()
+        stack = list(requirements)
+        while stack:
+            requirement_id, extras = stack.pop()
+            if requirement_id not in seen:
+                seen.add(requirement_id)
+                expanded.append(requirement_id)
+            for extra in extras:
+                if (requirement_id, extra) not in seen_extras:
+                    seen_extras.add((requirement_id, extra))
+                    stack.extend(self.extra_requirements.get(requirement_id, {}).get(extra, ()))
+        return expanded
+
+    def build(self):
+        offsets = array("i", [0]) * (len(self.nodes) + 1)
+        targets = array("i")
+        for node_id, requirements in enumerate(self.requirements):
+            if any((node_id, x) in self.requirement_extras for x in requirements):
+                requirements = self.expand_extras(
+                    node_id, [(x, self.requirement_extras.get((node_id, x), ())) for x in requirements]
+                )
+            targets.extend(sorted(requirements))
+            offsets[node_id + 1] = len(targets)
+        extras = {
+            node_id: {extra: sorted(self.expand_extras(node_id, x)) for extra, x in node_extras.items()}
+            for node_id, node_extras in self.extra_requirements.items()
+        }
+        return PackageGraph(self.nodes, offsets, targets, extras)
+
+
+def build_installed_graph(path_items, listings, distributions, local_only=True, markers=None, editable_paths=None):
+    """
+    Like the pkg_resources working set, the first distribution found on path_items for a name wins. listings maps each
+    path item to its list_path_item() result, distributions maps metadata paths to their read_distribution() result.
+    Requirement markers are evaluated by markers, against the running interpreter by default. editable_paths are the
+    metadata paths of editable installs, which are otherwise told by their direct_url.json.
+    """
+    markers = markers or running_markers
+    egg_links = {}
+    for path_item in path_items:
+        for egg_name in listings[path_item][1]:
+            egg_links.setdefault(egg_name, path_item)
+    builder = PackageGraphBuilder()
+    for path_item in path_items:
+        for path in listings[path_item][0]:
+            distribution = distributions.get(path)
+            if distribution is None:
+                continue
+            name, version, requires = distribution
+            key = normalize_package_name(name)
+            if builder.is_installed(key) or key in stdlib_packages:
+                continue
+            egg_link_dir = egg_links.get(name) or egg_links.get(name.replace("-", "_"))
+            if local_only and not is_local(egg_link_dir or path_item):
+                continue
+            if editable_paths is None:
+                editable = is_editable_direct_url(path)
+            else:
+                editable = path in editable_paths
+            node_id = builder.add_package(key, version, bool(egg_link_dir) or editable)
+            add_requires_dist(builder, node_id, requires, markers)
+    return builder.build()
+
+
+def add_requires_dist(builder, node_id, requires, markers):
+    """
+    Adds the Requires-Dist lines requires as requirements of node_id, or of its extras, when their markers apply.
+    """
+    for requirement in requires:
+        requirement = parse_requires_dist(requirement)
+        if not requirement:
+            continue
+        name, extras, marker = requirement
+        if not marker or markers.applies(marker):
+            builder.add_requirement(node_id, name, extras)
+            continue
+        for extra in marker_extras(marker):
+            if markers.applies(marker, extra):
+                builder.add_requirement(node_id, name, extras, extra=normalize_package_name(extra))
+
+
+def map_io(function, items, io_workers=1):
+    """
+    Returns function applied to each of items, in order. With more than one io_workers the calls are made on a pool of
+    threads, so the round trips of a network filesystem overlap.
+    """
+    if io_workers <= 1:
+        return [function(x) for x in items]
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=io_workers) as executor:
+        return list(executor.map(function, items))
+
+
+def scan_installed(path_items=None, local_only=True, io_workers=1, markers=None):
+    """
+    Walks path_items, sys.path by default, for installed distributions, reading on io_workers threads.
+    """
+    if path_items is None:
+        path_items = [x for x in sys.path if x]
+    with timer.phase("list"):
+        listings = dict(zip(path_items, map_io(list_path_item, path_items, io_workers)))
+    with timer.phase("metadata"):
+        paths = [path for x in listings.values() for path in x[0]]
+        distributions = dict(zip(paths, map_io(read_distribution, paths, io_workers)))
+    timer.count("distributions read", len(distributions))
+    with timer.phase("graph"):
+        return build_installed_graph(path_items, listings, distributions, local_only, markers)
+
+
+def read_pipdeptree_installed():
+    try:
+        # noinspection PyPackageRequirements
+        from pipdeptree import PackageDAG
+    except ImportError:
+        # later pipdeptree releases no longer export PackageDAG from the top level package.
+        raise ValueError(
+            "The pipdeptree backend needs pipdeptree>=2.0.0,<2.4.0, which export PackageDAG. Use --backend native."
+        )
+
+    try:
+        # noinspection PyPackageRequirements,PyCompatibility
+        from pip._internal.utils.misc import get_installed_distributions
+        from pip._internal.utils.misc import dist_is_editable
+    except ImportError:
+        # noinspection PyPackageRequirements,PyCompatibility
+        from pip import get_installed_distributions
+        from pip import dist_is_editable
+
+    tree = PackageDAG.from_pkgs(get_installed_distributions())
+    editable_packages = {normalize_package_name(p.project_name) for p in tree.keys() if dist_is_editable(p._obj)}
+    versions = {normalize_package_name(p.project_name): p.version for p in tree.keys()}
+    return PackageGraph.from_name_tree(package_tree_to_name_tree(tree), editable_packages, versions)
+
+
+def get_cache_path(site_packages=None):
+    """
+    Cache files are kept per interpreter, as each venv has its own sys.prefix and executable, or per set of
+    site-packages directories when reading another environment.
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    if site_packages:
+        key = "\0".join(os.path.realpath(x) for x in site_packages)
+    else:
+        key = "\0".join([os.path.realpath(sys.prefix), sys.executable])
+    return os.path.join(
+        cache_home, "extraneous", "{}.bin".format(hashlib.sha1(key.encode("utf-8", "surrogateescape")).hexdigest())
     )
-    parser.add_argument(
-        "--include",
-        "-i",
-        metavar="paths",
-        action="append",
-        help="Additional directories to look for '*requirements*.txt' files in.",
+
+
+def fingerprint_mtime(path):
+    try:
+        return distribution_mtime(path)
+    except OSError:
+        return 0
+
+
+def fingerprint_installed(path_items, io_workers=1):
+    """
+    A cheap fingerprint of the installed state: the names and distribution_mtime() of the metadata entries on each
+    path item.
+    """
+    digest = hashlib.sha1()
+    for path_item in path_items:
+        digest.update("{}\0".format(path_item).encode("utf-8", "surrogateescape"))
+        try:
+            entries = sorted(os.scandir(path_item), key=lambda x: x.name)
+        except OSError:
+            continue
+        entries = [x for x in entries if x.name.endswith((".dist-info", ".egg-info", ".egg-link", ".egg", ".pth"))]
+        for entry, mtime in zip(entries, map_io(fingerprint_mtime, [x.path for x in entries], io_workers)):
+            digest.update("{}\0{}\0".format(entry.name, mtime).encode("utf-8", "surrogateescape"))
+    return digest.hexdigest()
+
+
+def write_snapshot(path, graph, info=None):
+    """
+    Writes graph to path in the snapshot format, atomically. After a fixed size header come a JSON info object, the
+    NUL separated names and versions, a flags byte per node, the forward and reverse offsets and targets arrays as
+    little endian int32 and the extras as JSON.
+    """
+    import struct
+
+    names = "\0".join(node.name for node in graph.nodes).encode("utf-8", "surrogateescape")
+    versions = "\0".join(node.version or "" for node in graph.nodes).encode("utf-8", "surrogateescape")
+    flags = bytes(
+        (snapshot_installed if node.installed else 0) | (snapshot_editable if node.editable else 0)
+        for node in graph.nodes
     )
-    parser.add_argument(
-        "--exclude",
-        "-e",
-        metavar="names",
-        action="append",
-        default=[],
-        help="Package names to not consider extraneous."
-        " {} are not considered extraneous packages.".format(default_not_extraneous),
+    adjacency = [array("i", x) for x in [graph.offsets, graph.targets, graph.reverse_offsets, graph.reverse_targets]]
+    if sys.byteorder == "big":
+        for x in adjacency:
+            x.byteswap()
+    # json object keys are strings.
+    extras = json.dumps({str(k): v for k, v in graph.extras.items()}, separators=(",", ":")).encode("utf-8")
+    info = json.dumps(info or {}, separators=(",", ":")).encode("utf-8")
+    header = struct.pack(
+        snapshot_header,
+        snapshot_magic,
+        snapshot_version,
+        len(graph.nodes),
+        len(graph.targets),
+        len(info),
+        len(names),
+        len(versions),
+        len(extras),
     )
-    parser.add_argument(
-        "--full", "-f", action="store_true", help="Allows {} as extraneous packages.".format(default_not_extraneous)
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(temp_path, "wb") as snapshot_file:
+            for part in [header, info, names, versions, flags] + [x.tobytes() for x in adjacency] + [extras]:
+                snapshot_file.write(part)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+
+
+def read_snapshot(path):
+    """
+    Returns the graph and info of a snapshot written by write_snapshot(). Raises ValueError for anything else.
+    """
+    import struct
+
+    with open(path, "rb") as snapshot_file:
+        data = snapshot_file.read()
+    header_size = struct.calcsize(snapshot_header)
+    if len(data) < header_size or data[: len(snapshot_magic)] != snapshot_magic:
+        raise ValueError("{} is not an extraneous snapshot.".format(path))
+    _, version, node_count, edge_count, info_size, names_size, versions_size, extras_size = struct.unpack_from(
+        snapshot_header, data
     )
-    if args:
-        parsed_args = parser.parse_args(args)
-    else:
-        parsed_args = parser.parse_args()
-    installed, editable, tree = read_installed(parsed_args.verbose)
-    requirements = read_requirements(parsed_args.verbose, include=parsed_args.include)
-    for name in editable:
-        for requirement in list(requirements):
-            if requirement.endswith("#egg={}".format(name)):
-                requirements.remove(requirement)
-                requirements.add(name)
-    not_extraneous = set(parsed_args.exclude)
-    if not parsed_args.full:
-        not_extraneous |= set(default_not_extraneous)
-    extraneous = installed - requirements - not_extraneous
-    uninstall = set()
-    if extraneous:
-        print(color("extraneous packages:\n\t{}".format(" ".join(sorted(extraneous))), fg="yellow"))
-        uninstall = find_requirements_unique_to_projects(tree, requirements, extraneous, not_extraneous) - extraneous
-        print("uninstall via:\n\tpip uninstall -y {}".format(" ".join(sorted(extraneous) + sorted(uninstall))))
-    return extraneous, uninstall
+    if version != snapshot_version:
+        raise ValueError("{} is a version {} snapshot, expected version {}.".format(path, version, snapshot_version))
+    adjacency_sizes = [(node_count + 1) * 4, edge_count * 4] * 2
+    sizes = [info_size, names_size, versions_size, node_count] + adjacency_sizes + [extras_size]
+    if len(data) != header_size + sum(sizes):
+        raise ValueError("{} is truncated.".format(path))
+    parts = []
+    position = header_size
+    for size in sizes:
+        parts.append(data[position : position + size])
+        position += size
+    info, names, versions, flags = parts[:4]
+    extras = parts[-1]
+    adjacency = []
+    for part in parts[4:-1]:
+        x = array("i")
+        x.frombytes(part)
+        if sys.byteorder == "big":
+            x.byteswap()
+        adjacency.append(x)
+    offsets, targets, reverse_offsets, reverse_targets = adjacency
+    for x, y in [(offsets, targets), (reverse_offsets, reverse_targets)]:
+        if x[-1] != edge_count or (edge_count and not 0 <= min(y) <= max(y) < node_count):
+            raise ValueError("{} is corrupt.".format(path))
+    names = names.decode("utf-8", "surrogateescape").split("\0") if node_count else []
+    versions = versions.decode("utf-8", "surrogateescape").split("\0") if node_count else []
+    nodes = [
+        PackageNode(sys.intern(name), version or None, bool(flag & snapshot_editable), bool(flag & snapshot_installed))
+        for name, version, flag in zip(names, versions, flags)
+    ]
+    extras = {int(node_id): node_extras for node_id, node_extras in json.loads(extras.decode("utf-8")).items()}
+    graph = PackageGraph(nodes, offsets, targets, extras, reverse=(reverse_offsets, reverse_targets))
+    return graph, json.loads(info.decode("utf-8"))
+
+
+def load_installed_cache(cache_path, fingerprint, backend):
+    try:
+        graph, info = read_snapshot(cache_path)
+    except (OSError, ValueError):
+        return None
+    if (
+        info.get("cache_version") != cache_version
+        or info.get("fingerprint") != fingerprint
+        or info.get("backend") != backend
+    ):
+        return None
+    return graph
+
+
+def save_installed_cache(cache_path, fingerprint, backend, graph):
+    try:
+        write_snapshot(
+            cache_path, graph, {"cache_version": cache_version, "fingerprint": fingerprint, "backend": backend}
+        )
+    except OSError:
+        # the cache is only an optimization, an unwritable cache directory shouldn't fail the run.
+        pass
+
+
+def read_installed_snapshot(verbose, path):
+    """
+    Reads the installed packages of a --snapshot file, returning the same as read_installed().
+    """
+    if verbose:
+        print("reading installed from:\n\t{}".format(path))
+    graph, _ = read_snapshot(path)
+    project_names = graph.top_level_names()
+    return project_names, graph.editable_names() & project_names, graph
+
+
+def read_freeze_file(path, markers=None):
+    """
+    Returns the (name, version, editable) of each package pinned by a pip freeze output or lock file, following its -r
+    references. The version is None when it isn't pinned with ==. Editable installs of a path are named by the comment
+    pip freeze writes before them, and left out without one.
+    """
+    markers = markers or running_markers
+    if not os.path.isfile(path):
+        raise FileNotFoundError("{} not found.".format(path))
+    with open(path) as freeze_file:
+        editable_names = {
+            line_number + 1: match.groups()
+            for line_number, match in enumerate((re_freeze_editable.match(x) for x in freeze_file), 1)
+            if match
+        }
+    packages = []
+    for requirement in iter_requirements(path):
+        name, specifier = requirement.name, requirement.specifier
+        if not name and requirement.editable and requirement.path == path:
+            name, version = editable_names.get(requirement.line_number, (None, None))
+            name = name and normalize_package_name(name)
+            specifier = "=={}".format(version)
+        if not name or requirement.constraint:
+            continue
+        if requirement.marker and not markers.applies(requirement.marker):
+            continue
+        version = specifier.lstrip("=").strip() if specifier.startswith("==") and "," not in specifier else None
+        packages.append((name, version, requirement.editable))
+    return packages
+
 
+def read_wheel_metadata(path):
+    """
+    Reads the name, version and requirements of a *.whl, or of a *.metadata file holding the METADATA of one, like
+    the PEP 658 files an index serves next to its wheels.
+    """
+    import io
+    import zipfile
+
+    fields = ("name", "version", "requires-dist")
+    try:
+        if path.endswith(".metadata"):
+            with open(path, encoding="utf-8", errors="surrogateescape") as metadata_file:
+                metadata = read_headers(metadata_file, fields)
+        else:
+            with zipfile.ZipFile(path) as wheel:
+                names = [x for x in wheel.namelist() if re.match(r"^[^/]+\.dist-info/METADATA$", x)]
+                if not names:
+                    return None
+                with wheel.open(names[0]) as metadata_file:
+                    metadata = read_headers(
+                        io.TextIOWrapper(metadata_file, encoding="utf-8", errors="surrogateescape"), fields
+                    )
+    except (OSError, zipfile.BadZipFile):
+        return None
+    return metadata_distribution(path, metadata)
+
+
+def read_metadata_index(path):
+    """
+    Reads a JSON file mapping names to versions to their Requires-Dist lines.
+    """
+    with open(path) as index_file:
+        index = json.load(index_file)
+    return [(name, version, requires) for name, versions in index.items() for version, requires in versions.items()]
 
-class BadArgumentError(ValueError):
-    pass
+
+def read_metadata_sources(sources, io_workers=1):
+    """
+    Returns normalized names mapped to versions mapped to their Requires-Dist lines, read from each of sources: a
+    wheelhouse directory of *.whl and *.metadata files, or a read_metadata_index() file. The first source with a
+    version wins, and a wheel's *.whl.metadata is read instead of the wheel when both are there.
+    """
+    metadata = {}
+    for source in sources:
+        if os.path.isdir(source):
+            entries = set(os.listdir(source))
+            paths = sorted(
+                os.path.join(source, x)
+                for x in entries
+                if x.endswith(".metadata") or (x.endswith(".whl") and x + ".metadata" not in entries)
+            )
+            distributions = [x for x in map_io(read_wheel_metadata, paths, io_workers) if x]
+        else:
+            distributions = read_metadata_index(source)
+        timer.count("distributions read", len(distributions))
+        for name, version, requires in distributions:
+            metadata.setdefault(normalize_package_name(name), {}).setdefault(version, requires)
+    return metadata
 
 
-class NoExitArgumentParser(argparse.ArgumentParser):
-    def error(self, message):
-        raise BadArgumentError(self.format_usage(), message)
+def build_freeze_graph(packages, metadata, markers=None):
+    """
+    Builds the graph of the read_freeze_file() packages, with requirements from the read_metadata_sources() metadata.
+    A pinned package needs metadata of the same version, an unpinned one takes the first version found. Returns the
+    graph and the names of the packages without metadata, which have no requirements in it.
+    """
+    markers = markers or running_markers
+    builder = PackageGraphBuilder()
+    missing = set()
+    for name, version, editable in packages:
+        if builder.is_installed(name) or name in stdlib_packages:
+            continue
+        versions = metadata.get(name, {})
+        if not version:
+            version = next(iter(versions), None)
+        node_id = builder.add_package(name, version, editable)
+        requires = versions.get(version)
+        if requires is None:
+            missing.add(name)
+            continue
+        add_requires_dist(builder, node_id, requires, markers)
+    return builder.build(), missing
 
 
-argparse_class = NoExitArgumentParser
-if __name__ == "__main__":
-    argparse_class = argparse.ArgumentParser
-    main()
+def read_installed_freeze(verbose, path, metadata_sources=(), io_workers=1, markers=None):
+    """
+    Reads the installed packages of a pip freeze output or lock file, returning the same as read_installed().
+    """
+    if verbose:
+        print("reading installed from:\n\t{}".format(path))
+        if metadata_sources:
+            print("reading metadata from:\n\t{}".format("\n\t".join(metadata_sources)))
+    with timer.phase("freeze"):
+        packages = read_freeze_file(path, markers)
+    with timer.phase("metadata"):
+        metadata = read_metadata_sources(metadata_sources, io_workers)
+    with timer.phase("graph"):
+        graph, missing = build_freeze_graph(packages, metadata, markers)
+    if verbose and missing:
+        print("no metadata for:\n\t{}".format(" ".join(sorted(missing))))
+    project_names = graph.top_level_names()
+    return project_names, graph.editable_names() & project_names, graph
+
+
+def normalize_member_name(name):
+    name = name[2:] if name.startswith("./") else name
+    return posixpath.normpath(name).strip("/") if name.strip("/") else ""
+
+
+def is_indexed_image_member(name, working_dir):
+    """
+    Whether read_image_files() keeps a layer member: the metadata of distributions and *.egg-link files in
+    site-packages directories, and the *.txt files of the image's working directory, which can be requirements files.
+    """
+    match = re_image_member.match(name)
+    if not match:
+        return posixpath.dirname(name) == working_dir and name.endswith(".txt")
+    entry, member = match.group(2), match.group(3)
+    if member is None:
+        return entry.endswith((".egg-info", ".egg-link"))
+    if entry.endswith(".dist-info"):
+        return member in ("METADATA", "direct_url.json")
+    return entry.endswith(".egg-info") and member in ("PKG-INFO", "requires.txt")
+
+
+def read_image_member(name, member_file):
+    """
+    Returns the read_headers() of a METADATA or PKG-INFO member, stopping at the long description, and the bytes of
+    any other member.
+    """
+    if name.endswith(("/METADATA", "/PKG-INFO", ".egg-info")):
+        lines = (line.decode("utf-8", "surrogateescape") for line in member_file)
+        return read_headers(lines, ("name", "version", "requires-dist"))
+    return member_file.read()
+
+
+def apply_image_layer(files, layer_file, working_dir):
+    """
+    Streams the layer tarball layer_file onto files, the indexed members of the layers below it by name. A .wh.name
+    whiteout deletes name from the layers below, and a .wh..wh..opq whiteout everything in its directory, so whiteouts
+    are applied before the layer's own members.
+    """
+    import tarfile
+
+    whiteouts = []
+    added = {}
+    with tarfile.open(fileobj=layer_file, mode="r|*") as layer:
+        for member in layer:
+            name = normalize_member_name(member.name)
+            directory, base = posixpath.split(name)
+            if base.startswith(".wh."):
+                whiteouts.append(directory if base == ".wh..wh..opq" else posixpath.join(directory, base[4:]))
+            elif member.isfile() and is_indexed_image_member(name, working_dir):
+                timer.count("image members read")
+                added[name] = read_image_member(name, layer.extractfile(member))
+    if whiteouts:
+        # most whiteouts are of files the index doesn't keep, like the modules of an uninstalled package.
+        directories = {""}
+        for name in files:
+            while name:
+                name = posixpath.dirname(name)
+                directories.add(name)
+        for path in whiteouts:
+            if path in files or path in directories:
+                prefix = path + "/" if path else ""
+                for name in [x for x in files if x == path or x.startswith(prefix)]:
+                    del files[name]
+    files.update(added)
+
+
+def read_image_files(path):
+    """
+    Streams the layers of the first image in a docker save tarball in order, without extracting anything. Returns the
+    indexed members left after all whiteouts by name, the image's working directory and its config.
+    """
+    import tarfile
+
+    with tarfile.open(path) as image:
+        try:
+            manifest = json.load(image.extractfile("manifest.json"))[0]
+            config = json.load(image.extractfile(manifest["Config"]))
+        except (KeyError, IndexError, ValueError):
+            raise ValueError("{} is not a docker save tarball.".format(path))
+        working_dir = normalize_member_name((config.get("config") or {}).get("WorkingDir") or "/")
+        files = {}
+        for layer in manifest["Layers"]:
+            timer.count("layers")
+            apply_image_layer(files, image.extractfile(layer), working_dir)
+    return files, working_dir, config
+
+
+def image_marker_environment(site_packages, config):
+    """
+    The marker values of an image that can be told from its config and site-packages paths.
+    """
+    environment = {}
+    for path in site_packages:
+        match = re_python_version.search(path)
+        if match:
+            environment["python_version"] = match.group(1)
+            break
+    if config.get("os") == "linux":
+        environment.update(sys_platform="linux", platform_system="Linux", os_name="posix")
+    return environment
+
+
+def read_installed_image(verbose, path, markers=None):
+    """
+    Reads the installed packages of a docker save tarball, returning the same as read_installed() and the *.txt files
+    in the image's working directory by path.
+    """
+    with timer.phase("layers"):
+        files, working_dir, config = read_image_files(path)
+    entries = {}
+    text_files = {}
+    for name, content in files.items():
+        match = re_image_member.match(name)
+        if match:
+            site_packages, entry, member = match.groups()
+            entries.setdefault("/" + site_packages, {}).setdefault(entry, {})[member] = content
+        else:
+            text_files["/" + name] = content
+    # like sys.path, /usr/local comes before the distribution's own site-packages.
+    path_items = sorted(entries, key=lambda x: (not x.startswith("/usr/local/"), x))
+    if verbose:
+        print("reading installed from:\n\t{}".format("\n\t".join("{} in {}".format(x, path) for x in path_items)))
+    listings = {}
+    distributions = {}
+    editable_paths = set()
+    for path_item in path_items:
+        dist_paths = []
+        for entry, members in sorted(entries[path_item].items()):
+            metadata = members.get("METADATA", members.get("PKG-INFO", members.get(None)))
+            if entry.endswith(".egg-link") or metadata is None:
+                continue
+            dist_path = posixpath.join(path_item, entry)
+            dist_paths.append(dist_path)
+            requires = None
+            if entry.endswith(".egg-info"):
+                requires = parse_requires_txt(members.get("requires.txt", b"").decode("utf-8", "surrogateescape"))
+            distributions[dist_path] = metadata_distribution(dist_path, metadata, requires)
+            try:
+                if is_editable_direct_url_json(json.loads(members.get("direct_url.json", b"{}").decode("utf-8"))):
+                    editable_paths.add(dist_path)
+            except ValueError:
+                pass
+        egg_links = {x[: -len(".egg-link")] for x in entries[path_item] if x.endswith(".egg-link")}
+        listings[path_item] = (dist_paths, egg_links)
+    timer.count("distributions read", len(distributions))
+    markers = markers or MarkerEvaluator(image_marker_environment(path_items, config))
+    with timer.phase("graph"):
+        graph = build_installed_graph(path_items, listings, distributions, False, markers, editable_paths)
+    project_names = graph.top_level_names()
+    return project_names, graph.editable_names() & project_names, graph, text_files
+
+
+@contextmanager
+def image_requirements_root(text_files, include=None, files=None):
+    """
+    Yields a temporary directory holding text_files, the *.txt files of an image's working directory, when no
+    requirements files are found in the current working directory or include, so read_requirements() reads the
+    image's own. Yields None otherwise. The temporary paths collected in files are put back to the image's paths.
+    """
+    if not text_files or find_requirement_files(include):
+        yield None
+        return
+    from tempfile import TemporaryDirectory
+
+    with TemporaryDirectory(prefix="extraneous-image-") as root:
+        image_paths = {}
+        for image_path, content in text_files.items():
+            path = os.path.join(root, posixpath.basename(image_path))
+            image_paths[path] = image_path
+            with open(path, "wb") as text_file:
+                text_file.write(content)
+        yield root
+        if files is not None:
+            files[:] = [(image_paths.get(path, path), found) for path, found in files]
+
+
+def diff_graphs(before, after):
+    """
+    Returns the packages added, removed and changed in version or editable install from before to after, and the
+    requirements between packages added and removed.
+    """
+
+    def packages(graph):
+        return {node.name: node for node in graph.nodes if node.installed}
+
+    def edges(graph):
+        nodes = graph.nodes
+        return {(nodes[x].name, nodes[y].name) for x in range(len(graph)) for y in graph.requirements(x)}
+
+    def package(node):
+        return {"name": node.name, "version": node.version, "editable": node.editable}
+
+    before_packages, after_packages = packages(before), packages(after)
+    before_edges, after_edges = edges(before), edges(after)
+    return {
+        "added": [package(after_packages[x]) for x in sorted(set(after_packages) - set(before_packages))],
+        "removed": [package(before_packages[x]) for x in sorted(set(before_packages) - set(after_packages))],
+        "changed": [
+            {"name": x, "before": package(before_packages[x]), "after": package(after_packages[x])}
+            for x in sorted(set(before_packages) & set(after_packages))
+            if package(before_packages[x]) != package(after_packages[x])
+        ],
+        "added_requirements": [list(x) for x in sorted(after_edges - before_edges)],
+        "removed_requirements": [list(x) for x in sorted(before_edges - after_edges)],
+    }
+
+
+def describe_package(package):
+    return "{}{}{}".format(
+        package["name"],
+        "=={}".format(package["version"]) if package["version"] else "",
+        " (editable)" if package["editable"] else "",
+    )
+
+
+def print_diff(diff, output_format="text"):
+    if output_format == "json":
+        print(json.dumps(diff))
+        return
+    if output_format == "ndjson":
+        writer = RecordWriter(output_format)
+        for change, items in diff.items():
+            for item in items:
+                record = dict(item) if isinstance(item, dict) else {"name": item[0], "requirement": item[1]}
+                writer.write(dict(change=change, **record))
+        writer.close()
+        return
+    sections = [
+        ("added packages", [describe_package(x) for x in diff["added"]]),
+        ("removed packages", [describe_package(x) for x in diff["removed"]]),
+        (
+            "changed packages",
+            ["{} -> {}".format(describe_package(x["before"]), describe_package(x["after"])) for x in diff["changed"]],
+        ),
+        ("added requirements", ["{} -> {}".format(*x) for x in diff["added_requirements"]]),
+        ("removed requirements", ["{} -> {}".format(*x) for x in diff["removed_requirements"]]),
+    ]
+    sections = [(title, lines) for title, lines in sections if lines]
+    if not sections:
+        print("no differences")
+    for title, lines in sections:
+        print("{}:\n\t{}".format(title, "\n\t".join(lines)))
+
+
+def running_site_packages():
+    try:
+        # virtual environment with venv in python 3.3+
+        from site import getsitepackages
+
+        return getsitepackages()
+    except ImportError:
+        # virtual environment with virtualenv
+        # https://github.com/pypa/virtualenv/issues/228
+        from distutils.sysconfig import get_python_lib
+
+        return [get_python_lib()]
+
+
+def expand_site_packages(paths):
+    """
+    Returns the site-packages directories of paths, each either one itself or the root of an environment.
+    """
+    return list(flatten(find_site_packages(x) or [x] for x in paths))
+
+
+def print_installed_from(site_packages=None):
+    cwd = os.getcwd()
+    site_packages = site_packages or running_site_packages()
+    print("reading installed from:\n\t{}".format("\n\t".join([os.path.relpath(x, cwd) for x in site_packages])))
+
+
+def read_installed(
+    verbose=True, backend="native", use_cache=True, rebuild_cache=False, site_packages=None, io_workers=1, markers=None
+):
+    """
+    Reads the running interpreter's installed packages, or those in the site_packages directories of another
+    environment when given, along with what their *.pth and *.egg-link files add to its path. The native backend reads
+    metadata on io_workers threads. Requirement markers are evaluated by markers, by default against the running
+    interpreter or what is known of the other environment.
+    """
+    if verbose:
+        print_installed_from(site_packages)
+    graph = None
+    path_items = None
+    if site_packages:
+        # pip and pipdeptree only see the running interpreter.
+        backend = "native"
+        path_items = site_path_items(site_packages)
+    if use_cache:
+        cache_path = get_cache_path(site_packages)
+        with timer.phase("fingerprint"):
+            fingerprint = fingerprint_installed(path_items or [x for x in sys.path if x], io_workers)
+        if not rebuild_cache:
+            with timer.phase("load cache"):
+                graph = load_installed_cache(cache_path, fingerprint, backend)
+    if graph is None:
+        with timer.phase("scan"):
+            if backend == "pipdeptree":
+                graph = read_pipdeptree_installed()
+            elif site_packages:
+                markers = markers or MarkerEvaluator(target_marker_environment(site_packages))
+                graph = scan_installed(path_items, local_only=False, io_workers=io_workers, markers=markers)
+            else:
+                graph = scan_installed(io_workers=io_workers, markers=markers)
+        if use_cache:
+            with timer.phase("save cache"):
+                save_installed_cache(cache_path, fingerprint, backend, graph)
+    timer.count("packages", sum(1 for node in graph.nodes if node.installed))
+    timer.count("graph nodes", len(graph))
+    timer.count("graph edges", graph.edge_count())
+    project_names = graph.top_level_names()
+    return project_names, graph.editable_names() & project_names, graph
+
+
+def package_tree_to_name_tree(tree):
+    return {
+        normalize_package_name(k.project_name): {normalize_package_name(i.project_name) for i in v}
+        for k, v in tree.items()
+    }
+
+
+def strongly_connected_components(graph):
+    """
+    Tarjan's algorithm, iterative so deep dependency chains can't hit the recursion limit. Returns the component of
+    each node id and the number of components.
+    """
+    node_count = len(graph)
+    offsets, targets = graph.offsets, graph.targets
+    index = array("i", [-1]) * node_count
+    lowlink = array("i", [0]) * node_count
+    on_stack = bytearray(node_count)
+    component_of = array("i", [-1]) * node_count
+    stack = []
+    counter = 0
+    components = 0
+    for start in range(node_count):
+        if index[start] != -1:
+            continue
+        index[start] = lowlink[start] = counter
+        counter += 1
+        stack.append(start)
+        on_stack[start] = 1
+        work = [start]
+        positions = [offsets[start]]
+        while work:
+            node = work[-1]
+            position = positions[-1]
+            if position < offsets[node + 1]:
+                positions[-1] = position + 1
+                child = targets[position]
+                if index[child] == -1:
+                    index[child] = lowlink[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack[child] = 1
+                    work.append(child)
+                    positions.append(offsets[child])
+                elif on_stack[child] and index[child] < lowlink[node]:
+                    lowlink[node] = index[child]
+                continue
+            work.pop()
+            positions.pop()
+            if work and lowlink[node] < lowlink[work[-1]]:
+                lowlink[work[-1]] = lowlink[node]
+            if lowlink[node] == index[node]:
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = 0
+                    component_of[member] = components
+                    if member == node:
+                        break
+                components += 1
+    return component_of, components
+
+
+def immediate_dominators(graph, roots):
+    """
+    Returns the immediate dominator of each node id and the node ids in DFS postorder, for a virtual root, numbered
+    len(graph), that requires the node ids of roots and then, in id order, each installed package still unreached,
+    like those of a cycle nothing else requires. Uses the iterative algorithm of Cooper, Harvey and Kennedy, which
+    converges in a couple of passes over the reverse postorder of dependency graphs.
+    """
+    node_count = len(graph)
+    virtual = node_count
+    offsets, targets = graph.offsets, graph.targets
+    visited = bytearray(node_count)
+    order = []
+    from_root = set(roots)
+
+    def visit(start):
+        visited[start] = 1
+        work = [start]
+        positions = [offsets[start]]
+        while work:
+            node = work[-1]
+            position = positions[-1]
+            if position < offsets[node + 1]:
+                positions[-1] = position + 1
+                child = targets[position]
+                if not visited[child]:
+                    visited[child] = 1
+                    work.append(child)
+                    positions.append(offsets[child])
+                continue
+            work.pop()
+            positions.pop()
+            order.append(node)
+
+    for node_id in sorted(from_root):
+        if not visited[node_id]:
+            visit(node_id)
+    for node_id, node in enumerate(graph.nodes):
+        if node.installed and not visited[node_id]:
+            from_root.add(node_id)
+            visit(node_id)
+    postorder = array("i", [-1]) * (node_count + 1)
+    for number, node_id in enumerate(order):
+        postorder[node_id] = number
+    postorder[virtual] = len(order)
+    idom = array("i", [-1]) * (node_count + 1)
+    idom[virtual] = virtual
+
+    def intersect(a, b):
+        while a != b:
+            while postorder[a] < postorder[b]:
+                a = idom[a]
+            while postorder[b] < postorder[a]:
+                b = idom[b]
+        return a
+
+    changed = True
+    while changed:
+        changed = False
+        for node_id in reversed(order):
+            new_idom = virtual if node_id in from_root else -1
+            for parent in graph.required_by(node_id):
+                if idom[parent] != -1:
+                    new_idom = parent if new_idom == -1 else intersect(parent, new_idom)
+            if idom[node_id] != new_idom:
+                idom[node_id] = new_idom
+                changed = True
+    return idom[:node_count], order
+
+
+def iter_requirements_unique_to_projects(graph, requirements, root_package_names_to_uninstall, exclude_packages):
+    """
+    A package is uninstalled once everything that requires it is being uninstalled. Dependency cycles are collapsed
+    into strongly connected components first, so a cycle is uninstalled as a unit once nothing outside of it requires
+    any of its members. Each component keeps a count of the requiring packages that aren't being uninstalled yet.
+
+    Roots are uninstalled one at a time in the order given, releasing their requirements, and each is yielded with the
+    installed packages other than roots that this frees. A package shared by several roots is freed by the last of
+    them. A root that a package staying installed still requires isn't uninstalled, and neither are its requirements.
+    """
+    node_count = len(graph)
+    offsets, targets = graph.offsets, graph.targets
+    roots = bytearray(node_count)
+    for name in root_package_names_to_uninstall:
+        if name in graph.ids:
+            roots[graph.ids[name]] = 1
+    with timer.phase("components"):
+        component_of, component_count = strongly_connected_components(graph)
+    members = [[] for _ in range(component_count)]
+    for node_id in range(node_count):
+        members[component_of[node_id]].append(node_id)
+    kept = bytearray(component_count)
+    for name in chain(requirements, exclude_packages):
+        if name in graph.ids:
+            kept[component_of[graph.ids[name]]] = 1
+    remaining = array("i", [0]) * component_count
+    for source in range(node_count):
+        for position in range(offsets[source], offsets[source + 1]):
+            dependency = component_of[targets[position]]
+            if dependency != component_of[source]:
+                remaining[dependency] += 1
+
+    def release(node_id, worklist):
+        component = component_of[node_id]
+        for position in range(offsets[node_id], offsets[node_id + 1]):
+            dependency = component_of[targets[position]]
+            if dependency != component:
+                remaining[dependency] -= 1
+                if not remaining[dependency]:
+                    worklist.append(dependency)
+
+    expanded = bytearray(component_count)
+    for root in root_package_names_to_uninstall:
+        freed = set()
+        worklist = []
+        root_id = graph.ids.get(root)
+        # a root still required by a package that isn't uninstalled yet is expanded once that package is.
+        if root_id is not None and not remaining[component_of[root_id]]:
+            worklist.append(component_of[root_id])
+        while worklist:
+            component = worklist.pop()
+            if expanded[component] or kept[component]:
+                continue
+            expanded[component] = 1
+            for node_id in members[component]:
+                # requirements that aren't installed have nothing to uninstall.
+                if not roots[node_id] and graph.nodes[node_id].installed:
+                    freed.add(graph.nodes[node_id].name)
+                release(node_id, worklist)
+        yield root, freed
+
+
+def find_requirements_unique_to_projects(graph, requirements, root_package_names_to_uninstall, exclude_packages):
+    packages_to_uninstall = set(root_package_names_to_uninstall)
+    for _, freed in iter_requirements_unique_to_projects(
+        graph, requirements, root_package_names_to_uninstall, exclude_packages
+    ):
+        packages_to_uninstall |= freed
+    return packages_to_uninstall
+
+
+def iter_extraneous(installed, graph, requirements, not_extraneous, extras=()):
+    """
+    Yields each extraneous package, in name order, with the packages uninstalled along with it as soon as they are
+    known. The requirements of the (name, extra) pairs of extras are required too.
+    """
+    requirements = requirements | graph.extra_requirements(extras)
+    extraneous = sorted(installed - requirements - not_extraneous)
+    return iter_requirements_unique_to_projects(graph, requirements, extraneous, not_extraneous)
+
+
+def find_extraneous(installed, graph, requirements, not_extraneous, extras=()):
+    extraneous = set()
+    uninstall = set()
+    for name, freed in iter_extraneous(installed, graph, requirements, not_extraneous, extras):
+        extraneous.add(name)
+        uninstall |= freed
+    return extraneous, uninstall
+
+
+def rank_packages(graph, requirements, not_extraneous, extras=(), sizes=None):
+    """
+    Returns a record of each installed package that no other package alone keeps installed, the top level of the
+    dominator tree of the packages required by the requirements files, not_extraneous and the packages nothing
+    requires, with the packages only it keeps installed. Those are what uninstalling it alone removes along with it,
+    so every installed package is listed once. With the bytes of each package in sizes, records have the bytes they
+    free too. Sorted by the most packages kept.
+    """
+    requirements = requirements | graph.extra_requirements(extras)
+    roots = [
+        graph.ids[x]
+        for x in graph.top_level_names() | requirements | not_extraneous
+        if x in graph.ids and graph.nodes[graph.ids[x]].installed
+    ]
+    idom, order = immediate_dominators(graph, roots)
+    virtual = len(graph)
+    kept = {}
+    # dominators come before the nodes they dominate in reverse postorder.
+    top = {}
+    for node_id in reversed(order):
+        top[node_id] = node_id if idom[node_id] == virtual else top[idom[node_id]]
+        if graph.nodes[node_id].installed:
+            kept.setdefault(top[node_id], []).append(graph.nodes[node_id].name)
+    records = []
+    for node_id, names in kept.items():
+        node = graph.nodes[node_id]
+        record = {"name": node.name, "version": node.version, "packages": sorted(names[1:])}
+        if sizes is not None:
+            record["size"] = sum(sizes.get(x, 0) for x in names)
+        records.append(record)
+    return sorted(records, key=lambda x: (-len(x["packages"]), -x.get("size", 0), x["name"]))
+
+
+def iter_extraneous_records(installed, graph, requirements, not_extraneous, files, extras=()):
+    """
+    Yields a record of each extraneous package for --format json and ndjson as soon as its closure is computed. files
+    are the (path, found) pairs of the requirements files read.
+    """
+    requirement_files = [os.path.abspath(path) for path, found in files if found]
+    for name, freed in iter_extraneous(installed, graph, requirements, not_extraneous, extras):
+        node = graph.nodes[graph.ids[name]]
+        yield {
+            "name": name,
+            "version": node.version,
+            "editable": node.editable,
+            "uninstall": sorted(freed),
+            "requirement_files": requirement_files,
+        }
+
+
+def iter_parent_paths(parents, node):
+    """
+    Yields each path from a node without parents to node, following parents, which maps each node to the nodes it was
+    reached from. Iterative, like strongly_connected_components().
+    """
+    stack = [(node, [node])]
+    while stack:
+        node, path = stack.pop()
+        if not parents[node]:
+            yield path[::-1]
+        for parent in reversed(parents[node]):
+            stack.append((parent, path + [parent]))
+
+
+def shortest_requirement_paths(graph, sources, target, limit=10):
+    """
+    Returns up to limit of the shortest requirement paths from any of the sources node ids to the target node id.
+    A breadth first search runs from both ends, forward along requirements from the sources and backward along the
+    reverse edges from the target, always growing the smaller frontier a whole level at a time. The first level that
+    meets the other side holds the middle node of every shortest path.
+    """
+    if target in sources:
+        return [[target]]
+    forward = {x: [] for x in sources}
+    backward = {target: []}
+    frontiers = [list(forward), [target]]
+    while frontiers[0] and frontiers[1]:
+        side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+        visited, other = (forward, backward) if side == 0 else (backward, forward)
+        neighbours = graph.requirements if side == 0 else graph.required_by
+        level = []
+        discovered = set()
+        for node in frontiers[side]:
+            for neighbour in neighbours(node):
+                if neighbour not in visited:
+                    visited[neighbour] = [node]
+                    level.append(neighbour)
+                    discovered.add(neighbour)
+                elif neighbour in discovered:
+                    visited[neighbour].append(node)
+        frontiers[side] = level
+        meeting = [x for x in level if x in other]
+        if meeting:
+            paths = (
+                head + tail[::-1][1:]
+                for middle in sorted(meeting)
+                for head in iter_parent_paths(forward, middle)
+                for tail in iter_parent_paths(backward, middle)
+            )
+            return [path for path, _ in zip(paths, range(limit))]
+    return []
+
+
+def answer_why(graph, requirements, not_extraneous, name, extras=()):
+    """
+    The shortest paths from a requirement, or a package that isn't extraneous, to name, which keep it installed.
+    """
+    name = normalize_package_name(name)
+    keeping = requirements | graph.extra_requirements(extras) | not_extraneous
+    sources = {graph.ids[x] for x in keeping if x in graph.ids}
+    node_id = graph.ids.get(name)
+    paths = []
+    if node_id is not None:
+        with timer.phase("why"):
+            paths = shortest_requirement_paths(graph, sources, node_id)
+    installed = node_id is not None and graph.nodes[node_id].installed
+    return {"why": name, "installed": installed, "paths": [[graph.nodes[x].name for x in path] for path in paths]}
+
+
+def answer_what_if(graph, requirements, not_extraneous, names, extras=()):
+    """
+    What uninstalling names would remove along with them, were they dropped from the requirements, and the packages
+    that would be left requiring them.
+    """
+    names = {normalize_package_name(x) for x in names}
+    requirements = (requirements | graph.extra_requirements(extras)) - names
+    with timer.phase("what-if"):
+        uninstall = find_requirements_unique_to_projects(graph, requirements, sorted(names), not_extraneous - names)
+    required_by = {}
+    for name in sorted(names & set(graph.ids)):
+        kept = {graph.nodes[x].name for x in graph.required_by(graph.ids[name])} - uninstall
+        if kept:
+            required_by[name] = sorted(kept)
+    return {"what_if": sorted(names), "uninstall": sorted(uninstall - names), "required_by": required_by}
+
+
+def print_answer(answer, output_format="text"):
+    if output_format != "text":
+        print(json.dumps(answer))
+    elif "why" in answer and answer["paths"]:
+        print(
+            "{} is required through:\n\t{}".format(
+                answer["why"], "\n\t".join(" -> ".join(path) for path in answer["paths"])
+            )
+        )
+    elif "why" in answer:
+        print(
+            "{} isn't {}".format(
+                answer["why"],
+                "required by the requirements files or excluded packages" if answer["installed"] else "installed",
+            )
+        )
+    else:
+        names = " ".join(answer["what_if"])
+        if answer["uninstall"]:
+            print("uninstalling {} also removes:\n\t{}".format(names, " ".join(answer["uninstall"])))
+        else:
+            print("uninstalling {} removes nothing else".format(names))
+        for name, required_by in sorted(answer["required_by"].items()):
+            print("{} is still required by:\n\t{}".format(name, " ".join(required_by)))
+
+
+def answer_query(graph, requirements, not_extraneous, query, extras=()):
+    if query.get("why"):
+        return answer_why(graph, requirements, not_extraneous, query["why"], extras)
+    return answer_what_if(graph, requirements, not_extraneous, query["what_if"], extras)
+
+
+def records_to_extraneous(records):
+    extraneous = set()
+    uninstall = set()
+    for record in records:
+        extraneous.add(record["name"])
+        uninstall.update(record["uninstall"])
+    return extraneous, uninstall
+
+
+class RecordWriter(object):
+    """
+    Writes records as they come, one JSON document per line for ndjson or the elements of a single JSON array for
+    json, flushing after each so consumers can process them in a pipeline.
+    """
+
+    def __init__(self, output_format, stream=None):
+        self.output_format = output_format
+        self.stream = stream or sys.stdout
+        self.written = 0
+
+    def write(self, record):
+        if self.output_format == "ndjson":
+            self.stream.write(json.dumps(record) + "\n")
+        else:
+            self.stream.write(("[\n" if not self.written else ",\n") + json.dumps(record))
+        self.written += 1
+        self.stream.flush()
+
+    def close(self):
+        if self.output_format == "json":
+            self.stream.write("\n]\n" if self.written else "[]\n")
+            self.stream.flush()
+
+
+def verbose_output(output_format):
+    """
+    Keeps stdout for the records of --format json and ndjson, the --verbose listings go to stderr instead.
+    """
+    return redirect_stdout(sys.stderr if output_format != "text" else sys.stdout)
+
+
+def print_extraneous(extraneous, uninstall):
+    if extraneous:
+        # noinspection PyUnresolvedReferences,PyPackageRequirements
+        from colors import color
+
+        print(color("extraneous packages:\n\t{}".format(" ".join(sorted(extraneous))), fg="yellow"))
+        print("uninstall via:\n\tpip uninstall -y {}".format(" ".join(sorted(extraneous) + sorted(uninstall))))
+
+
+def uninstall_batches(graph, names):
+    """
+    Orders the removal of names so a package goes before the packages it requires, returning batches of names that
+    can be removed in parallel. The packages of a requirement cycle are removed in the same batch.
+    """
+    component_of, _ = strongly_connected_components(graph)
+    removing = {graph.ids[x] for x in names if x in graph.ids}
+    levels = {}
+    # Tarjan numbers a component after all the components it requires, so dependents come first in this order.
+    for node_id in sorted(removing, key=lambda x: -component_of[x]):
+        level = levels.setdefault(component_of[node_id], 0)
+        for requirement in graph.requirements(node_id):
+            if requirement in removing and component_of[requirement] != component_of[node_id]:
+                levels[component_of[requirement]] = max(levels.get(component_of[requirement], 0), level + 1)
+    batches = [[] for _ in range(max(levels.values()) + 1 if levels else 0)]
+    for node_id in removing:
+        batches[levels[component_of[node_id]]].append(graph.nodes[node_id].name)
+    return [sorted(x) for x in batches]
+
+
+def find_distribution_paths(names, path_items=None):
+    """
+    Returns the metadata path of each of names installed on path_items, sys.path by default, where the first found
+    wins like build_installed_graph(), and the names installed as *.egg-link editables.
+    """
+    if path_items is None:
+        path_items = [x for x in sys.path if x]
+    paths = {}
+    egg_links = set()
+    for path_item in path_items:
+        dist_paths, egg_link_names = list_path_item(path_item)
+        egg_links.update(normalize_package_name(x) for x in egg_link_names)
+        for path in dist_paths:
+            # the file name is only a hint, pip escapes names in it.
+            file_name = os.path.basename(os.path.dirname(path) if path.endswith("EGG-INFO") else path)
+            if normalize_package_name(file_name.split("-")[0]) not in names:
+                continue
+            distribution = read_distribution(path)
+            name = distribution and normalize_package_name(distribution[0])
+            if name in names and name not in paths:
+                paths[name] = path
+    return paths, egg_links & set(names)
+
+
+def read_manifest(metadata_path):
+    """
+    Returns the directory the paths of the RECORD of a *.dist-info or the installed-files.txt of an *.egg-info are
+    relative to and its (path, size) entries, the size None when not listed, or None when it has neither.
+    """
+    import csv
+
+    if metadata_path.endswith(".dist-info"):
+        manifest_path, root = os.path.join(metadata_path, "RECORD"), os.path.dirname(metadata_path)
+    else:
+        manifest_path, root = os.path.join(metadata_path, "installed-files.txt"), metadata_path
+    try:
+        with open(manifest_path, newline="", encoding="utf-8", errors="surrogateescape") as manifest:
+            if metadata_path.endswith(".dist-info"):
+                entries = [
+                    (row[0], int(row[2]) if row[2:] and row[2].isdigit() else None)
+                    for row in csv.reader(manifest)
+                    if row
+                ]
+            else:
+                entries = [(line.strip(), None) for line in manifest if line.strip()]
+    except OSError:
+        return None
+    return root, entries
+
+
+def list_bytecode(directory):
+    """
+    Returns the *.pyc files in the __pycache__ of directory, grouped by the part of their name before the first dot.
+    """
+    names = {}
+    try:
+        entries = os.listdir(os.path.join(directory, "__pycache__"))
+    except OSError:
+        return names
+    for name in entries:
+        if name.endswith(".pyc"):
+            names.setdefault(name.split(".", 1)[0], []).append(name)
+    return names
+
+
+def read_installed_entries(metadata_path):
+    """
+    Returns the absolute path of each file installed with the distribution at metadata_path, from the RECORD of a
+    *.dist-info or the installed-files.txt of an *.egg-info, mapped to its size in the RECORD or None, or None when it
+    has neither. The metadata files and the __pycache__ of each module are included, as pip uninstall removes them
+    too, whether or not they exist.
+    """
+    manifest = read_manifest(metadata_path)
+    if manifest is None:
+        return None
+    root, entries = manifest
+    files = {os.path.normpath(os.path.join(root, path)): size for path, size in entries}
+    for directory, _, file_names in os.walk(metadata_path):
+        for file_name in file_names:
+            files.setdefault(os.path.join(directory, file_name), None)
+    bytecode = {}
+    for path in list(files):
+        if path.endswith(".py"):
+            directory, file_name = os.path.split(path)
+            if directory not in bytecode:
+                bytecode[directory] = list_bytecode(directory)
+            # <module>.<cache tag>.pyc, like foo.cpython-39.pyc or foo.cpython-39.opt-1.pyc.
+            prefix = file_name[:-3] + "."
+            for name in bytecode[directory].get(prefix.split(".", 1)[0], ()):
+                if name.startswith(prefix):
+                    files.setdefault(os.path.join(directory, "__pycache__", name), None)
+    return files
+
+
+def read_installed_files(metadata_path):
+    """
+    Returns the sorted read_installed_entries() paths of the distribution at metadata_path that exist, or None.
+    """
+    files = read_installed_entries(metadata_path)
+    if files is None:
+        return None
+    return sorted(x for x in files if os.path.lexists(x))
+
+
+def plan_uninstall(graph, names, path_items=None):
+    """
+    Returns the uninstall_batches() of names, the files of each name, each file only under the first package that
+    lists it, and the site-packages directories they're installed in. Raises ValueError naming the packages that
+    can't be removed from their files. Names the graph has as requirements that aren't installed are skipped.
+    """
+    names = {x for x in names if x not in graph.ids or graph.nodes[graph.ids[x]].installed}
+    paths, egg_links = find_distribution_paths(names, path_items)
+    problems = ["{} is an *.egg-link editable install".format(x) for x in sorted(egg_links)]
+    problems += ["{} isn't installed on sys.path".format(x) for x in sorted(set(names) - set(paths) - egg_links)]
+    files = {}
+    claimed = set()
+    prefix = os.path.realpath(sys.prefix)
+    for name, path in sorted(paths.items()):
+        installed_files = read_installed_files(path)
+        if installed_files is None:
+            problems.append("{} has no RECORD or installed-files.txt".format(name))
+            continue
+        site_dir = os.path.dirname(path)
+        outside = [x for x in installed_files if not any(is_within(x, y) for y in (site_dir, prefix))]
+        if outside:
+            problems.append("{} lists files outside of {}: {}".format(name, prefix, " ".join(outside)))
+        files[name] = [x for x in installed_files if x not in claimed]
+        claimed.update(installed_files)
+    if problems:
+        raise ValueError("can't uninstall:\n\t{}".format("\n\t".join(problems)))
+    return uninstall_batches(graph, names), files, sorted({os.path.dirname(x) for x in paths.values()})
+
+
+def is_within(path, directory):
+    path, directory = os.path.realpath(path), os.path.realpath(directory)
+    return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
+
+
+def read_owned_paths(metadata_path, site_dir):
+    """
+    Returns the normcased paths relative to site_dir that the distribution at metadata_path lists in its manifest,
+    leaving out those installed elsewhere, like scripts.
+    """
+    manifest = read_manifest(metadata_path)
+    if manifest is None:
+        return []
+    root, entries = manifest
+    # string concatenation and normpath rather than relpath, as there can be hundreds of thousands of paths.
+    prefix = os.path.relpath(root, site_dir) + os.sep if root != site_dir else ""
+    paths = []
+    for path, _ in entries:
+        if os.path.isabs(path):
+            path = os.path.relpath(path, site_dir)
+        path = os.path.normpath(prefix + path)
+        if path != os.pardir and not path.startswith(os.pardir + os.sep):
+            paths.append(os.path.normcase(path))
+    return paths
+
+
+def build_ownership_index(site_dir, io_workers=1):
+    """
+    Returns the set of paths relative to site_dir owned by the distributions installed in it, from all of their
+    manifests read on io_workers threads, and the set of directories holding any of them.
+    """
+    metadata_paths = list_path_item(site_dir)[0]
+    owned = set()
+    for paths in map_io(lambda x: read_owned_paths(x, site_dir), metadata_paths, io_workers):
+        owned.update(paths)
+    timer.count("owned paths", len(owned))
+    directories = set()
+    for path in owned:
+        directory = path.rpartition(os.sep)[0]
+        while directory and directory not in directories:
+            directories.add(directory)
+            directory = directory.rpartition(os.sep)[0]
+    return owned, directories
+
+
+def directory_size(path):
+    """
+    Returns the bytes taken by the files under path, not following symlinks.
+    """
+    size = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        size += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            continue
+    return size
+
+
+def is_owned_bytecode(source_prefix, name, owned):
+    """
+    Whether name, a file in the __pycache__ directory of the directory source_prefix, is the bytecode of an owned
+    module, which python writes as it imports without any manifest listing it.
+    """
+    return name.endswith(".pyc") and os.path.normcase(source_prefix + name.partition(".")[0] + ".py") in owned
+
+
+def iter_orphans(site_dir, io_workers=1):
+    """
+    Yields (path relative to site_dir, whether it's a directory, size) of each file and directory under site_dir no
+    distribution owns, in one os.scandir() walk that only descends into directories holding owned files. Unowned
+    directories are reported as a whole, and distributions' metadata, *.egg-link and *.egg installs and
+    easy-install.pth aren't listed in any manifest but are owned.
+    """
+    owned, owned_directories = build_ownership_index(site_dir, io_workers)
+    stack = [""]
+    while stack:
+        relative = stack.pop()
+        parent, _, name = relative.rpartition(os.sep)
+        # the modules of a __pycache__ are in its parent directory.
+        source_prefix = (parent + os.sep if parent else "") if name == "__pycache__" else None
+        prefix = relative + os.sep if relative else ""
+        try:
+            with os.scandir(os.path.join(site_dir, relative)) as entries:
+                entries = sorted(entries, key=lambda x: x.name)
+        except OSError:
+            continue
+        timer.count("site-packages entries walked", len(entries))
+        subdirectories = []
+        for entry in entries:
+            path = prefix + entry.name
+            key = os.path.normcase(path)
+            if key in owned or entry.name.endswith(unrecorded_suffixes) or entry.name in unrecorded_names:
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if key in owned_directories or entry.name == "__pycache__":
+                        subdirectories.append(path)
+                    else:
+                        yield path, True, directory_size(entry.path)
+                elif source_prefix is None or not is_owned_bytecode(source_prefix, entry.name, owned):
+                    yield path, False, entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                continue
+        stack.extend(reversed(subdirectories))
+
+
+def format_size(size):
+    for unit in ["B", "KiB", "MiB"]:
+        if size < 1024:
+            return "{} {}".format(size, unit) if unit == "B" else "{:.1f} {}".format(size, unit)
+        size /= 1024
+    return "{:.1f} GiB".format(size)
+
+
+def print_orphans(site_packages, output_format="text", io_workers=1):
+    """
+    Prints the files and directories of site_packages no distribution owns as they are found, with their sizes.
+    """
+    writer = RecordWriter(output_format) if output_format != "text" else None
+    count = 0
+    total = 0
+    for site_dir in site_packages:
+        for path, is_dir, size in iter_orphans(site_dir, io_workers):
+            if writer:
+                writer.write({"site_packages": site_dir, "path": path, "directory": is_dir, "size": size})
+            else:
+                if not count:
+                    print("orphaned files:")
+                print("\t{}{} ({})".format(os.path.join(site_dir, path), os.sep if is_dir else "", format_size(size)))
+            count += 1
+            total += size
+    if writer:
+        writer.close()
+    elif count:
+        print("{} orphaned, {} in total".format(count, format_size(total)))
+    else:
+        print("no orphaned files")
+
+
+def file_size(path):
+    try:
+        return os.lstat(path).st_size
+    except OSError:
+        return None
+
+
+def read_top_level(metadata_path):
+    """
+    Returns the top level modules and packages of the distribution at metadata_path from its top_level.txt, or None
+    when it has none, as wheels built without setuptools don't.
+    """
+    try:
+        with open(os.path.join(metadata_path, "top_level.txt"), encoding="utf-8") as top_level_file:
+            return {line.strip().split("/")[0] for line in top_level_file if line.strip()}
+    except OSError:
+        return None
+
+
+def read_kept_files(removed_paths, removed_files):
+    """
+    Returns the files of removed_files also listed by a distribution that stays, installed next to the metadata
+    paths removed_paths. Only the manifests of the distributions staying whose top_level.txt names something at the
+    top of removed_files, or that have no top_level.txt, are read, so the cost mostly follows what's removed rather
+    than the environment.
+    """
+    removed = set(removed_paths)
+    tops = {}
+    for site_dir in {os.path.dirname(x) for x in removed_paths}:
+        prefix = site_dir + os.sep
+        # top_level.txt names modules, foo for foo.py or foo.cpython-39-x86_64-linux-gnu.so.
+        tops[site_dir] = {
+            x[len(prefix) :].split(os.sep, 1)[0].split(".", 1)[0] for x in removed_files if x.startswith(prefix)
+        }
+    kept = set()
+    for site_dir, site_tops in tops.items():
+        for metadata_path in list_path_item(site_dir)[0]:
+            if metadata_path in removed or os.path.isfile(metadata_path):
+                continue
+            top_level = read_top_level(metadata_path)
+            if top_level is not None and not top_level & site_tops:
+                continue
+            timer.count("kept manifests read")
+            kept.update(read_installed_entries(metadata_path) or ())
+    return kept & removed_files
+
+
+def read_measured_entries(metadata_path):
+    """
+    Returns the read_installed_entries() of the distribution at metadata_path, or the size of the whole *.egg of an
+    EGG-INFO.
+    """
+    if os.path.basename(metadata_path) == "EGG-INFO":
+        egg = os.path.dirname(metadata_path)
+        return {egg: directory_size(egg) if os.path.isdir(egg) else file_size(egg)}
+    return read_installed_entries(metadata_path) or {}
+
+
+def measure_uninstall(names, path_items=None, io_workers=1):
+    """
+    Returns the bytes uninstalling each of names installed on path_items, sys.path by default, frees and the names
+    that are *.egg-link editable installs, whose files aren't removed. Sizes come from the size column of each RECORD,
+    with os.lstat() on io_workers threads for the files listed without one, like those of an *.egg-info. A file
+    listed by several of names counts under the first, and one listed by a package that stays doesn't count.
+    """
+    paths, egg_links = find_distribution_paths(set(names), path_items)
+    names = sorted(paths)
+    entries = map_io(lambda x: read_measured_entries(paths[x]), names, io_workers)
+    sizes = {}
+    claimed = {}
+    for name, files in zip(names, entries):
+        for path, size in files.items():
+            if path not in claimed:
+                claimed[path] = (name, size)
+    with timer.phase("kept"):
+        kept = read_kept_files(list(paths.values()), set(claimed))
+    unsized = [x for x, (_, size) in claimed.items() if size is None and x not in kept]
+    timer.count("files stat", len(unsized))
+    stat_sizes = dict(zip(unsized, map_io(file_size, unsized, io_workers)))
+    for name in names:
+        sizes[name] = 0
+    for path, (name, size) in claimed.items():
+        if path not in kept:
+            sizes[name] += (stat_sizes.get(path) or 0) if size is None else size
+    for name in egg_links:
+        sizes.setdefault(name, 0)
+    return sizes, egg_links
+
+
+def print_sizes(sizes, editable=()):
+    print("reclaimable space:")
+    for name, size in sorted(sizes.items(), key=lambda x: (-x[1], x[0])):
+        print("\t{:<40}{:>12}{}".format(name, format_size(size), " (editable)" if name in editable else ""))
+    print("\t{:<40}{:>12}".format("total", format_size(sum(sizes.values()))))
+
+
+def print_rank(records, output_format="text"):
+    if output_format != "text":
+        writer = RecordWriter(output_format)
+        for record in records:
+            writer.write(record)
+        writer.close()
+        return
+    print("packages only kept installed by each package:")
+    for record in records:
+        print(
+            "\t{:<40}{:>6}{}{}".format(
+                record["name"],
+                len(record["packages"]),
+                "{:>12}".format(format_size(record["size"])) if "size" in record else "",
+                "  " + " ".join(record["packages"]) if record["packages"] else "",
+            )
+        )
+
+
+class Uninstaller(object):
+    """
+    Removes files by moving them to a stash directory, writing each move to a rollback manifest first, so a removal
+    that fails midway, or is killed, can be undone with rollback(). commit() deletes the stash.
+    """
+
+    def __init__(self, stash_parent):
+        import tempfile
+        import threading
+
+        self.stash = tempfile.mkdtemp(prefix=".extraneous-uninstall-", dir=stash_parent)
+        self.manifest_path = os.path.join(self.stash, "rollback.ndjson")
+        self.manifest = open(self.manifest_path, "a")
+        self.lock = threading.Lock()
+        self.moved = 0
+        self.removed_directories = 0
+
+    def log(self, entries):
+        with self.lock:
+            self.manifest.write("".join(json.dumps(x) + "\n" for x in entries))
+            self.manifest.flush()
+            os.fsync(self.manifest.fileno())
+
+    def remove_files(self, paths):
+        import shutil
+
+        with self.lock:
+            moves = [(x, os.path.join(self.stash, str(self.moved + number))) for number, x in enumerate(paths)]
+            self.moved += len(moves)
+        # logged before any is moved, rollback_uninstall() skips what wasn't.
+        self.log([{"moved": x} for x in moves])
+        for path, stashed in moves:
+            # a rename within a filesystem, a copy to another, like a script in bin/.
+            shutil.move(path, stashed)
+
+    def remove_empty_directories(self, paths, roots):
+        """
+        Removes the directories that held paths and are now empty, deepest first, up to but not including roots.
+        Directories shared with other packages, like namespace packages, still hold their files and are kept.
+        """
+        directories = set()
+        for path in paths:
+            directory = os.path.dirname(path)
+            while any(is_within(directory, x) and directory != x for x in roots) and directory not in directories:
+                directories.add(directory)
+                directory = os.path.dirname(directory)
+        for directory in sorted(directories, key=lambda x: -x.count(os.sep)):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                continue
+            self.removed_directories += 1
+            self.log([{"removed_directory": directory}])
+
+    def commit(self):
+        import shutil
+
+        self.manifest.close()
+        shutil.rmtree(self.stash)
+
+    def rollback(self):
+        self.manifest.close()
+        rollback_uninstall(self.manifest_path)
+
+
+def rollback_uninstall(manifest_path):
+    """
+    Undoes the removals of an Uninstaller's rollback manifest, last first, then deletes its stash.
+    """
+    import shutil
+
+    with open(manifest_path) as manifest:
+        entries = [json.loads(line) for line in manifest if line.strip()]
+    for entry in reversed(entries):
+        if "removed_directory" in entry:
+            os.makedirs(entry["removed_directory"], exist_ok=True)
+            continue
+        path, stashed = entry["moved"]
+        if os.path.lexists(stashed):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.move(stashed, path)
+    shutil.rmtree(os.path.dirname(manifest_path))
+
+
+def apply_uninstall(graph, names, dry_run=False, io_workers=1, path_items=None):
+    """
+    Removes the files of names in uninstall_batches() order, the packages of each batch on io_workers threads. All
+    removals are rolled back when one fails. With dry_run only prints what would be removed.
+    """
+    batches, files, site_dirs = plan_uninstall(graph, names, path_items)
+    print("uninstall order:\n\t{}".format("\n\t".join(" ".join(x) for x in batches)))
+    file_count = sum(len(x) for x in files.values())
+    if dry_run:
+        print("would remove {} files of {} packages".format(file_count, len(files)))
+        return
+    if not files:
+        return
+    uninstaller = Uninstaller(site_dirs[0])
+    try:
+        for batch in batches:
+            with timer.phase("batch"):
+                map_io(uninstaller.remove_files, [files[x] for x in batch], io_workers)
+        uninstaller.remove_empty_directories(list(flatten(files.values())), site_dirs)
+    except BaseException:
+        print("uninstall failed, rolling back from:\n\t{}".format(uninstaller.manifest_path), file=sys.stderr)
+        uninstaller.rollback()
+        raise
+    uninstaller.commit()
+    print(
+        "removed {} files and {} directories of {} packages".format(
+            uninstaller.moved, uninstaller.removed_directories, len(files)
+        )
+    )
+
+
+def find_site_packages(env_root):
+    site_packages = []
+    seen = set()
+    for pattern in ["lib/python*/site-packages", "lib64/python*/site-packages", "Lib/site-packages"]:
+        for path in sorted(glob.glob(os.path.join(env_root, pattern))):
+            # lib64 is usually a symlink to lib.
+            if os.path.realpath(path) not in seen:
+                seen.add(os.path.realpath(path))
+                site_packages.append(path)
+    return site_packages
+
+
+def read_environments(envs):
+    """
+    envs is either a directory whose subdirectories are environment roots, each holding its own requirements files,
+    or a file listing an environment root and optionally its requirements directory per line.
+    """
+    if os.path.isdir(envs):
+        return [
+            (os.path.join(envs, x), os.path.join(envs, x))
+            for x in sorted(os.listdir(envs))
+            if os.path.isdir(os.path.join(envs, x)) and find_site_packages(os.path.join(envs, x))
+        ]
+    environments = []
+    list_dir = os.path.dirname(envs)
+    with open(envs) as envs_file:
+        for line in envs_file:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            env_root, _, requirements_dir = line.partition(" ")
+            requirements_dir = requirements_dir.strip() or env_root
+            environments.append((os.path.join(list_dir, env_root), os.path.join(list_dir, requirements_dir)))
+    return environments
+
+
+def analyze_environment(env_root, requirements_dir, include, not_extraneous, use_cache, rebuild_cache, io_workers=1):
+    """
+    Runs in a worker process of the fleet mode, reading the environment's site-packages without running its python.
+    Returns the records of the extraneous packages and an error message.
+    """
+    site_packages = find_site_packages(env_root)
+    if not site_packages:
+        return None, "No site-packages found."
+    files = []
+    extras = set()
+    markers = MarkerEvaluator(target_marker_environment(site_packages))
+    try:
+        installed, editable, graph = read_installed(
+            False,
+            use_cache=use_cache,
+            rebuild_cache=rebuild_cache,
+            site_packages=site_packages,
+            io_workers=io_workers,
+            markers=markers,
+        )
+        requirements = read_requirements(
+            False, include=include, root=requirements_dir, files=files, extras=extras, markers=markers
+        )
+    except ValueError as e:
+        return None, str(e)
+    return list(iter_extraneous_records(installed, graph, requirements, not_extraneous, files, extras)), None
+
+
+def analyze_environments(
+    environments, include, not_extraneous, use_cache=True, rebuild_cache=False, output_format="text", io_workers=1
+):
+    results = []
+    if not environments:
+        return results
+    writer = RecordWriter(output_format) if output_format != "text" else None
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=min(len(environments), os.cpu_count() or 1)) as executor:
+        futures = [
+            executor.submit(
+                analyze_environment,
+                env_root,
+                requirements_dir,
+                include,
+                not_extraneous,
+                use_cache,
+                rebuild_cache,
+                io_workers,
+            )
+            for env_root, requirements_dir in environments
+        ]
+        for (env_root, requirements_dir), future in zip(environments, futures):
+            records, error = future.result()
+            extraneous, uninstall = records_to_extraneous(records) if records is not None else (None, None)
+            if writer and error:
+                writer.write({"environment": env_root, "requirements_dir": requirements_dir, "error": error})
+            elif writer:
+                for record in records:
+                    writer.write(dict(environment=env_root, requirements_dir=requirements_dir, **record))
+            else:
+                if requirements_dir == env_root:
+                    print("{}:".format(env_root))
+                else:
+                    print("{} ({}):".format(env_root, requirements_dir))
+                if error:
+                    print("\t{}".format(error))
+                else:
+                    print_extraneous(extraneous, uninstall)
+            results.append((env_root, requirements_dir, extraneous, uninstall))
+    if writer:
+        writer.close()
+    return results
+
+
+class InotifyWatcher(object):
+    """
+    Watches directories for entries being created, removed, renamed or written to through Linux's inotify.
+    """
+
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    mask = 0x002 | 0x004 | 0x008 | 0x040 | 0x080 | 0x100 | 0x200
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        # raises AttributeError where there is no inotify.
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = {}
+
+    def watch(self, path):
+        watch_descriptor = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask)
+        if watch_descriptor >= 0:
+            self.paths[watch_descriptor] = path
+
+    def watch_metadata(self, path):
+        # files written inside a *.dist-info directory don't raise events on site-packages itself.
+        self.watch(path)
+
+    def wait(self, timeout=None):
+        import select
+        import struct
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        data = os.read(self.fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            watch_descriptor, _, _, name_length = struct.unpack_from("iIII", data, offset)
+            offset += struct.calcsize("iIII") + name_length
+            if watch_descriptor in self.paths:
+                changed.add(self.paths[watch_descriptor])
+        return changed
+
+
+class PollingWatcher(object):
+    """
+    Watches directories by comparing the names and mtimes of their entries every interval seconds.
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.snapshots = {}
+
+    @staticmethod
+    def snapshot(path):
+        try:
+            return sorted((x.name, x.stat().st_mtime_ns) for x in os.scandir(path))
+        except OSError:
+            return None
+
+    def watch(self, path):
+        self.snapshots[path] = self.snapshot(path)
+
+    def watch_metadata(self, path):
+        # the site-packages snapshot already holds the mtime of each *.dist-info directory.
+        pass
+
+    def wait(self, timeout=None):
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        changed = set()
+        for path, snapshot in list(self.snapshots.items()):
+            current = self.snapshot(path)
+            if current != snapshot:
+                self.snapshots[path] = current
+                changed.add(path)
+        return changed
+
+
+def get_watcher():
+    try:
+        return InotifyWatcher()
+    except (AttributeError, OSError):
+        return PollingWatcher()
+
+
+class Daemon(object):
+    """
+    Keeps the installed graph and parsed requirements files in memory for --serve, re-reading only the distributions
+    and requirements files in directories the watcher reports as changed.
+    """
+
+    def __init__(self, watcher, path_items=None):
+        import threading
+
+        self.watcher = watcher
+        self.path_items = path_items or [x for x in sys.path if x]
+        self.lock = threading.Lock()
+        self.listings = {}
+        self.distributions = {}
+        self.mtimes = {}
+        self.parents = {}
+        self.requirement_files = {}
+        for path_item in self.path_items:
+            self.refresh_path_item(path_item)
+            self.watcher.watch(path_item)
+        self.graph = build_installed_graph(self.path_items, self.listings, self.distributions)
+
+    def refresh_path_item(self, path_item):
+        listing = list_path_item(path_item)
+        for path in set(self.listings.get(path_item, ([], set()))[0]) - set(listing[0]):
+            self.distributions.pop(path, None)
+            self.mtimes.pop(path, None)
+            self.parents.pop(path, None)
+        for path in listing[0]:
+            if path not in self.parents:
+                self.parents[path] = path_item
+                if os.path.isdir(path):
+                    self.watcher.watch_metadata(path)
+            try:
+                mtime = distribution_mtime(path)
+            except OSError:
+                mtime = None
+            if path not in self.distributions or self.mtimes.get(path) != mtime:
+                self.distributions[path] = read_distribution(path)
+                # retried on the next change when the metadata isn't written yet.
+                self.mtimes[path] = mtime if self.distributions[path] else None
+        self.listings[path_item] = listing
+
+    def on_change(self, changed):
+        with self.lock:
+            path_items = set()
+            for path in changed:
+                if path in self.listings:
+                    path_items.add(path)
+                if path in self.parents:
+                    # rewritten in place, so the mtime of the directory may not have changed.
+                    self.mtimes.pop(path, None)
+                    path_items.add(self.parents[path])
+                for requirement_file, (_, files) in list(self.requirement_files.items()):
+                    if any(os.path.dirname(x) == path for x, _ in files):
+                        del self.requirement_files[requirement_file]
+            for path_item in path_items:
+                self.refresh_path_item(path_item)
+            if path_items:
+                self.graph = build_installed_graph(self.path_items, self.listings, self.distributions)
+
+    def read_requirement_file(self, path):
+        if path not in self.requirement_files:
+            self.requirement_files[path] = read_requirement_file(path)
+            for file_path, _ in self.requirement_files[path][1]:
+                self.watcher.watch(os.path.dirname(file_path))
+        return self.requirement_files[path]
+
+    def query(self, request):
+        with self.lock:
+            reqs = set()
+            files = []
+            extras = set()
+            for path in request["files"]:
+                names, requirement_files, requirement_extras = self.read_requirement_file(path)
+                reqs |= names
+                files.append(requirement_files)
+                extras |= requirement_extras
+            reqs.discard(None)
+            if not reqs:
+                return {"files": files, "error": no_requirements_message(request["verbose"])}
+            if request.get("query"):
+                answer = answer_query(self.graph, reqs, set(request["not_extraneous"]), request["query"], extras)
+                return {"files": files, "answer": answer}
+            records = list(
+                iter_extraneous_records(
+                    self.graph.top_level_names(),
+                    self.graph,
+                    reqs,
+                    set(request["not_extraneous"]),
+                    flatten(files),
+                    extras,
+                )
+            )
+        extraneous, uninstall = records_to_extraneous(records)
+        return {"files": files, "extraneous": sorted(extraneous), "uninstall": sorted(uninstall), "records": records}
+
+    def watch_forever(self):
+        while True:
+            changed = self.watcher.wait()
+            if changed:
+                self.on_change(changed)
+
+
+def create_daemon_server(socket_path, daemon):
+    """
+    Binds the unix socket answering queries from daemon.
+    """
+    import socketserver
+
+    class DaemonRequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline()
+            if not line:
+                # serve() probing whether a daemon is already listening.
+                return
+            request = json.loads(line.decode("utf-8"))
+            self.wfile.write(json.dumps(self.server.daemon.query(request)).encode("utf-8") + b"\n")
+
+    class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    server = DaemonServer(socket_path, DaemonRequestHandler)
+    server.daemon = daemon
+    return server
+
+
+def get_socket_path():
+    return "{}.sock".format(os.path.splitext(get_cache_path())[0])
+
+
+def serve(socket_path, verbose=True):
+    import signal
+    import socket
+    import threading
+
+    if os.path.exists(socket_path):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.connect(socket_path)
+        except OSError:
+            # left behind by a daemon that didn't exit cleanly.
+            os.unlink(socket_path)
+        else:
+            raise ValueError("A daemon is already listening on {}.".format(socket_path))
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+    daemon = Daemon(get_watcher())
+    watcher_thread = threading.Thread(target=daemon.watch_forever, daemon=True)
+    watcher_thread.start()
+    server = create_daemon_server(socket_path, daemon)
+    if verbose:
+        print("serving on {} with {}".format(socket_path, type(daemon.watcher).__name__))
+    # exit through the finally below, removing the socket.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+
+def query_daemon(socket_path, request):
+    import socket
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        response = b""
+        while not response.endswith(b"\n"):
+            chunk = client.recv(64 * 1024)
+            if not chunk:
+                break
+            response += chunk
+    return json.loads(response.decode("utf-8"))
+
+
+def run_client(
+    socket_path,
+    verbose,
+    include,
+    not_extraneous,
+    output_format="text",
+    query=None,
+    include_recursive=None,
+    ignore=(),
+    max_depth=None,
+):
+    """
+    Asks the --serve daemon for the analysis of the requirements files found from the current working directory, or
+    the answer to a --why or --what-if query. Returns None when no daemon is listening.
+    """
+    requirement_files = find_requirement_files(include)
+    for directory in include_recursive or ():
+        requirement_files += walk_requirement_files(directory, ignore, max_depth)
+    # the walk finds the current working directory's files again when it's one of include_recursive.
+    unique_files = {}
+    for rname in requirement_files:
+        unique_files.setdefault(os.path.abspath(rname), rname)
+    requirement_files = list(unique_files.values())
+    request = {
+        "files": [os.path.abspath(x) for x in requirement_files],
+        "not_extraneous": sorted(not_extraneous),
+        "verbose": verbose,
+        "query": query,
+    }
+    try:
+        response = query_daemon(socket_path, request)
+    except OSError:
+        return None
+    if verbose:
+        with verbose_output(output_format):
+            print_installed_from()
+            print("reading requirements from:")
+            cwd = os.getcwd()
+            for rname, files in zip(requirement_files, response["files"]):
+                for path, found in files:
+                    path = path if os.path.isabs(rname) else os.path.relpath(path, cwd)
+                    print("\t{}{}".format(path, "" if found else " (Not Found)"))
+    if "error" in response:
+        raise ValueError(response["error"])
+    if "answer" in response:
+        print_answer(response["answer"], output_format)
+        return set(), set()
+    extraneous, uninstall = set(response["extraneous"]), set(response["uninstall"])
+    if output_format == "text":
+        print_extraneous(extraneous, uninstall)
+    else:
+        writer = RecordWriter(output_format)
+        for record in response["records"]:
+            writer.write(record)
+        writer.close()
+    return extraneous, uninstall
+
+
+class Environment(object):
+    """
+    The installed packages of an environment, read once and kept: the running interpreter's by default, those of the
+    site_packages directories or environment roots of another one, a --snapshot file, a pip freeze file with the
+    metadata_from sources of its requirements, or a docker save tarball.
+    """
+
+    def __init__(
+        self,
+        site_packages=None,
+        against=None,
+        installed_from=None,
+        metadata_from=(),
+        image_tar=None,
+        backend="native",
+        use_cache=True,
+        rebuild_cache=False,
+        io_workers=1,
+        verbose=False,
+    ):
+        self.site_packages = site_packages
+        self.against = against
+        self.installed_from = installed_from
+        self.metadata_from = metadata_from
+        self.image_tar = image_tar
+        self.backend = backend
+        self.use_cache = use_cache
+        self.rebuild_cache = rebuild_cache
+        self.io_workers = io_workers
+        self.verbose = verbose
+        self.result = None
+
+    def refresh(self):
+        """
+        Forgets the packages read, so they are read again when next used.
+        """
+        self.result = None
+
+    def read(self):
+        """
+        Returns the top level package names, the editable ones, the PackageGraph and the requirements files of an
+        image's working directory, reading them on first use.
+        """
+        if self.result is None:
+            with timer.phase("read installed"):
+                self.result = self.read_installed()
+        return self.result
+
+    def read_installed(self):
+        if self.against:
+            return read_installed_snapshot(self.verbose, self.against) + ({},)
+        if self.installed_from:
+            return read_installed_freeze(
+                self.verbose, self.installed_from, self.metadata_from or [], io_workers=self.io_workers
+            ) + ({},)
+        if self.image_tar:
+            return read_installed_image(self.verbose, self.image_tar)
+        site_packages = None
+        if self.site_packages:
+            site_packages = expand_site_packages(self.site_packages)
+        return read_installed(
+            self.verbose,
+            backend=self.backend,
+            use_cache=self.use_cache,
+            rebuild_cache=self.rebuild_cache,
+            site_packages=site_packages,
+            io_workers=self.io_workers,
+        ) + ({},)
+
+    def path_items(self):
+        """
+        Returns the sys.path of the environment when it's another one, or None for the running interpreter's.
+        """
+        return site_path_items(expand_site_packages(self.site_packages)) if self.site_packages else None
+
+    def measure(self, names):
+        """
+        Returns the measure_uninstall() of names in the environment, leaving out requirements that aren't installed.
+        """
+        graph = self.graph
+        names = [x for x in names if x not in graph.ids or graph.nodes[graph.ids[x]].installed]
+        with timer.phase("sizes"):
+            return measure_uninstall(names, self.path_items(), self.io_workers)
+
+    @property
+    def installed(self):
+        return self.read()[0]
+
+    @property
+    def editable(self):
+        return self.read()[1]
+
+    @property
+    def graph(self):
+        return self.read()[2]
+
+    @property
+    def image_files(self):
+        return self.read()[3]
+
+
+class Analyzer(object):
+    """
+    Finds the extraneous packages of an Environment, the running interpreter's by default. The installed packages and
+    each requirements file are only read once, so changing exclude, full, the include settings or requirements, a set
+    of names used instead of the requirements files, between calls only reruns the closure.
+    """
+
+    def __init__(
+        self,
+        environment=None,
+        include=None,
+        root=None,
+        include_recursive=None,
+        ignore=(),
+        max_depth=None,
+        exclude=(),
+        full=False,
+        requirements=None,
+        io_workers=1,
+        verbose=False,
+    ):
+        self.environment = environment or Environment(io_workers=io_workers, verbose=verbose)
+        self.include = include
+        self.root = root
+        self.include_recursive = include_recursive
+        self.ignore = ignore
+        self.max_depth = max_depth
+        self.exclude = exclude
+        self.full = full
+        self.requirements = requirements
+        self.io_workers = io_workers
+        self.verbose = verbose
+        self.requirement_files = {}
+        self.results = {}
+
+    def refresh(self):
+        """
+        Forgets the installed packages and requirements files read, so they are read again when next used.
+        """
+        self.environment.refresh()
+        self.requirement_files.clear()
+        self.results.clear()
+
+    @property
+    def not_extraneous(self):
+        not_extraneous = set(self.exclude)
+        if not self.full:
+            not_extraneous |= set(default_not_extraneous)
+        return not_extraneous
+
+    def read_requirements(self):
+        """
+        Returns the required names, the (path, found) pairs of the requirements files read and the (name, extra) pairs
+        of the extras requested, read once for each set of include settings.
+        """
+        if self.requirements is not None:
+            return set(self.requirements), [], set()
+        key = (
+            tuple(self.include or ()),
+            self.root,
+            tuple(self.include_recursive or ()),
+            tuple(self.ignore),
+            self.max_depth,
+        )
+        if key not in self.results:
+            files = []
+            extras = set()
+            image_files = self.environment.image_files
+            with timer.phase("read requirements"):
+                with image_requirements_root(image_files, self.include, files) as root:
+                    requirements = read_requirements(
+                        self.verbose,
+                        include=self.include,
+                        root=root or self.root,
+                        files=files,
+                        extras=extras,
+                        include_recursive=self.include_recursive,
+                        ignore=self.ignore,
+                        max_depth=self.max_depth,
+                        io_workers=self.io_workers,
+                        cache=self.requirement_files,
+                    )
+            self.results[key] = requirements, files, extras
+        return self.results[key]
+
+    def find_extraneous(self):
+        """
+        Returns the extraneous packages and the packages uninstalled along with them.
+        """
+        requirements, _, extras = self.read_requirements()
+        with timer.phase("closure"):
+            return find_extraneous(
+                self.environment.installed, self.environment.graph, requirements, self.not_extraneous, extras
+            )
+
+    def iter_records(self):
+        """
+        Yields the --format json record of each extraneous package as soon as its closure is computed.
+        """
+        requirements, files, extras = self.read_requirements()
+        return iter_extraneous_records(
+            self.environment.installed, self.environment.graph, requirements, self.not_extraneous, files, extras
+        )
+
+    def answer(self, query):
+        """
+        Returns the answer to a {"why": name, "what_if": names} query.
+        """
+        requirements, _, extras = self.read_requirements()
+        return answer_query(self.environment.graph, requirements, self.not_extraneous, query, extras)
+
+    def rank(self, sizes=False):
+        """
+        Returns the rank_packages() records of the environment, with the bytes each frees when sizes is true.
+        """
+        requirements, _, extras = self.read_requirements()
+        graph = self.environment.graph
+        measured = self.environment.measure([x.name for x in graph.nodes if x.installed])[0] if sizes else None
+        with timer.phase("rank"):
+            return rank_packages(graph, requirements, self.not_extraneous, extras, measured)
+
+
+def run(parsed_args):
+    environment = Environment(
+        site_packages=parsed_args.site_packages,
+        against=parsed_args.against,
+        installed_from=parsed_args.installed_from,
+        metadata_from=parsed_args.metadata_from,
+        image_tar=parsed_args.image_tar,
+        backend=parsed_args.backend,
+        use_cache=not parsed_args.no_cache,
+        rebuild_cache=parsed_args.rebuild_cache,
+        io_workers=parsed_args.io_workers,
+        verbose=parsed_args.verbose,
+    )
+    analyzer = Analyzer(
+        environment,
+        include=parsed_args.include,
+        include_recursive=parsed_args.include_recursive,
+        ignore=parsed_args.ignore,
+        max_depth=parsed_args.max_depth,
+        exclude=parsed_args.exclude,
+        full=parsed_args.full,
+        io_workers=parsed_args.io_workers,
+        verbose=parsed_args.verbose,
+    )
+    not_extraneous = analyzer.not_extraneous
+    socket_path = parsed_args.socket or get_socket_path()
+    query = None
+    if parsed_args.why or parsed_args.what_if:
+        query = {"why": parsed_args.why, "what_if": parsed_args.what_if}
+    if parsed_args.serve:
+        return serve(socket_path, parsed_args.verbose)
+    if parsed_args.client:
+        with timer.phase("client"):
+            result = run_client(
+                socket_path,
+                parsed_args.verbose,
+                parsed_args.include,
+                not_extraneous,
+                parsed_args.format,
+                query,
+                parsed_args.include_recursive,
+                parsed_args.ignore,
+                parsed_args.max_depth,
+            )
+        if result is not None:
+            return result
+    if parsed_args.envs:
+        with timer.phase("environments"):
+            return analyze_environments(
+                read_environments(parsed_args.envs),
+                parsed_args.include,
+                not_extraneous,
+                use_cache=not parsed_args.no_cache,
+                rebuild_cache=parsed_args.rebuild_cache,
+                output_format=parsed_args.format,
+                io_workers=parsed_args.io_workers,
+            )
+    if parsed_args.rollback:
+        rollback_uninstall(parsed_args.rollback)
+        return set(), set()
+    if parsed_args.orphans:
+        site_packages = expand_site_packages(parsed_args.site_packages or []) or running_site_packages()
+        with timer.phase("orphans"):
+            print_orphans(site_packages, parsed_args.format, parsed_args.io_workers)
+        return set(), set()
+    if parsed_args.diff:
+        with timer.phase("diff"):
+            print_diff(diff_graphs(*[read_snapshot(x)[0] for x in parsed_args.diff]), parsed_args.format)
+        return set(), set()
+    with verbose_output(parsed_args.format):
+        tree = environment.graph
+    if parsed_args.snapshot:
+        with timer.phase("snapshot"):
+            write_snapshot(parsed_args.snapshot, tree)
+        if parsed_args.verbose:
+            print("snapshot written to:\n\t{}".format(parsed_args.snapshot))
+        return set(), set()
+    with verbose_output(parsed_args.format):
+        analyzer.read_requirements()
+    if query:
+        print_answer(analyzer.answer(query), parsed_args.format)
+        return set(), set()
+    if parsed_args.rank:
+        print_rank(analyzer.rank(parsed_args.sizes), parsed_args.format)
+        return set(), set()
+    if parsed_args.format != "text":
+        writer = RecordWriter(parsed_args.format)
+        extraneous, uninstall = set(), set()
+        records = analyzer.iter_records()
+        if parsed_args.sizes:
+            # the sizes of all records are measured together, so files shared between them count once.
+            with timer.phase("closure"):
+                records = list(records)
+            sizes, _ = environment.measure(flatten([x["name"]] + x["uninstall"] for x in records))
+            records = [
+                dict(x, sizes={y: sizes[y] for y in [x["name"]] + x["uninstall"] if y in sizes}) for x in records
+            ]
+        # written as each closure is computed, so this phase includes the output.
+        with timer.phase("closure"):
+            for record in records:
+                writer.write(record)
+                extraneous.add(record["name"])
+                uninstall.update(record["uninstall"])
+        writer.close()
+    else:
+        extraneous, uninstall = analyzer.find_extraneous()
+        with timer.phase("print"):
+            print_extraneous(extraneous, uninstall)
+        if parsed_args.sizes and extraneous:
+            sizes, editable = environment.measure(extraneous | uninstall)
+            print_sizes(sizes, editable)
+    if parsed_args.apply or parsed_args.dry_run:
+        with timer.phase("apply"), verbose_output(parsed_args.format):
+            apply_uninstall(tree, extraneous | uninstall, parsed_args.dry_run, parsed_args.io_workers)
+    return extraneous, uninstall
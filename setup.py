@@ -17,7 +17,7 @@ with open("requirements.txt", "r") as req:
         author="Arrai Innovations",
         author_email="support@arrai.com",
         packages=["extraneous"],
-        scripts=["extraneous/extraneous.py"],
+        scripts=["bin/extraneous.py"],
         install_requires=[x for x in req.read().split("\n") if x],
         license="LICENSE",
         test_suite="tests",
@@ -0,0 +1,18 @@
+# Copyright (C) 2018 Arrai Innovations Inc. - All Rights Reserved
+from setuptools import setup
+
+setup(
+    name="extraneous_cycle_package_2",
+    url="https://github.com/arrai-innovations/extraneous/",
+    version="1.0.0",
+    description="Package used by extraneous tests.",
+    author="Arrai Innovations",
+    author_email="support@arrai.com",
+    install_requires=["extraneous_cycle_package_1"],
+    classifiers=[
+        "Development Status :: 1 - Planning",
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3.7",
+        "Intended Audience :: Developers",
+    ],
+)
@@ -1,7 +1,14 @@
 # Copyright (C) 2018 Arrai Innovations Inc. - All Rights Reserved
+import glob
+import io
+import json
 import os
 import subprocess
+import tarfile
+import time
 import venv
+import zipfile
+from contextlib import contextmanager
 from tempfile import TemporaryDirectory
 from unittest import TestCase
 
@@ -88,7 +95,7 @@ class ExtraneousTestCase(TestCase):
                 """[run]
 branch = True
 parallel = True
-include = *extraneous/extraneous.py
+include = *extraneous/*.py
 
 [report]
 exclude_lines =
@@ -137,6 +144,36 @@ exclude_lines =
         )
         return ran.stdout.decode("utf8").strip()
 
+    @contextmanager
+    def dangling_requirement(self, package, requirement):
+        """
+        Makes the installed package require requirement, which isn't installed, until the block exits.
+        """
+        site_packages = os.path.join(self.cwd_path, self.get_sitepackages_for_venv().split("\n\t")[0])
+        metadata_path = glob.glob(os.path.join(site_packages, "{}-*-info".format(package)))[0]
+        dist_info = metadata_path.endswith(".dist-info")
+        path = os.path.join(metadata_path, "METADATA" if dist_info else "requires.txt")
+        original = None
+        if os.path.exists(path):
+            with open(path) as original_file:
+                original = original_file.read()
+        with open(path, mode="w") as w:
+            if dist_info:
+                # in the header block, after the first line.
+                w.write(original.replace("\n", "\nRequires-Dist: {}\n".format(requirement), 1))
+            else:
+                w.write("{}\n{}".format(requirement, original or ""))
+        try:
+            yield
+        finally:
+            # --apply may have uninstalled it.
+            if os.path.isdir(metadata_path):
+                if original is None:
+                    os.unlink(path)
+                else:
+                    with open(path, mode="w") as w:
+                        w.write(original)
+
     def test_verbose(self):
         extraneous = self.subcmd("`which extraneous.py` -v", coverage=True)
         self.assertMultiLineEqual(
@@ -198,6 +235,639 @@ exclude_lines =
             extraneous.stdout.decode("utf8"),
         )
 
+    def test_backend_pipdeptree(self):
+        native = self.subcmd("`which extraneous.py` -v --backend native", coverage=True)
+        pipdeptree = self.subcmd("`which extraneous.py` -v --backend pipdeptree", coverage=True)
+        self.assertMultiLineEqual(pipdeptree.stdout.decode("utf8"), native.stdout.decode("utf8"))
+        with TemporaryDirectory() as shadow:
+            # a pipdeptree without PackageDAG at the top level, like its later releases.
+            with open(os.path.join(shadow, "pipdeptree.py"), "w") as w:
+                w.write("")
+            with self.assertRaises(subprocess.CalledProcessError) as raised:
+                self.subcmd("PYTHONPATH={} `which extraneous.py` --no-cache --backend pipdeptree".format(shadow))
+            self.assertIn("Use --backend native.", raised.exception.stderr.decode("utf8"))
+
+    def test_startup_imports(self):
+        # the script itself, the one pip installs for an editable install can import pkg_resources.
+        script = os.path.join(os.getcwd(), "bin", "extraneous.py")
+        for arguments in ["-h", "--not-an-argument"]:
+            startup = subprocess.run(
+                "python -X importtime {} {}".format(script, arguments),
+                shell=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                cwd=self.cwd_path,
+                env=self.env_vars,
+            )
+            imported = {x.split("|")[-1].strip() for x in startup.stderr.decode("utf8").splitlines() if "|" in x}
+            self.assertIn("extraneous.cli", imported)
+            for heavy in ["extraneous.extraneous", "pkg_resources", "pip", "pipdeptree", "colors", "email.parser"]:
+                self.assertNotIn(heavy, imported)
+            self.assertIn("usage: extraneous.py", (startup.stdout + startup.stderr).decode("utf8"))
+
+        def fastest(command):
+            seconds = []
+            # the first run writes the bytecode.
+            for _ in range(6):
+                start = time.perf_counter()
+                subprocess.run(
+                    command, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=self.env_vars
+                )
+                seconds.append(time.perf_counter() - start)
+            return min(seconds[1:])
+
+        # what the script adds to starting the interpreter.
+        interpreter = fastest("python -c pass")
+        for arguments in ["-h", "--not-an-argument"]:
+            self.assertLess(fastest("python {} {}".format(script, arguments)) - interpreter, 0.05)
+
+    def test_format(self):
+        ndjson = self.subcmd("`which extraneous.py` -v --format ndjson", coverage=True)
+        records = [json.loads(line) for line in ndjson.stdout.decode("utf8").splitlines()]
+        self.assertIn("reading requirements from:", ndjson.stderr.decode("utf8"))
+        self.assertEqual(
+            {
+                "extraneous-top-package-2": ["extraneous-sub-package-2"],
+                "extraneous-top-package-4": [
+                    "extraneous-sub-package-3",
+                    "extraneous-sub-sub-package-1",
+                    "extraneous-sub-sub-package-2",
+                ],
+            },
+            {record["name"]: record["uninstall"] for record in records},
+        )
+        for record in records:
+            self.assertEqual("1.0.0", record["version"])
+            self.assertFalse(record["editable"])
+            self.assertEqual(
+                [os.path.join(self.cwd_path, x) for x in ["requirements.txt", "test_requirements.txt"]],
+                [os.path.join(self.cwd_path, os.path.basename(x)) for x in record["requirement_files"]],
+            )
+        document = self.subcmd("`which extraneous.py` --format json", coverage=True)
+        self.assertEqual(records, json.loads(document.stdout.decode("utf8")))
+
+    def test_requirement_not_installed(self):
+        with self.dangling_requirement("extraneous_top_package_4", "extraneous-not-installed"):
+            text = self.subcmd("`which extraneous.py` --no-cache", coverage=True).stdout.decode("utf8")
+            ndjson = self.subcmd("`which extraneous.py` --no-cache --format ndjson", coverage=True)
+            sizes = self.subcmd("`which extraneous.py` --no-cache --sizes", coverage=True).stdout.decode("utf8")
+            sizes_json = self.subcmd("`which extraneous.py` --no-cache --sizes --format json", coverage=True)
+        self.assertIn("extraneous-sub-sub-package-2", text)
+        self.assertNotIn("extraneous-not-installed", text)
+        self.assertIn("reclaimable space:\n", sizes)
+        self.assertNotIn("extraneous-not-installed", sizes)
+        self.assertNotIn("extraneous-not-installed", sizes_json.stdout.decode("utf8"))
+        records = {x["name"]: x for x in map(json.loads, ndjson.stdout.decode("utf8").splitlines())}
+        self.assertEqual(
+            ["extraneous-sub-package-3", "extraneous-sub-sub-package-1", "extraneous-sub-sub-package-2"],
+            records["extraneous-top-package-4"]["uninstall"],
+        )
+
+    def test_cache(self):
+        def run(arguments=""):
+            timed = self.subcmd("`which extraneous.py` --timings json {}".format(arguments), coverage=True)
+            phases = {x["name"] for x in json.loads(timed.stderr.decode("utf8"))["phases"]}
+            return timed.stdout.decode("utf8"), phases
+
+        cache_phases = {"read installed.fingerprint", "read installed.load cache", "read installed.save cache"}
+        rebuilt, phases = run("--rebuild-cache")
+        self.assertLessEqual({"read installed.scan", "read installed.save cache"}, phases)
+        self.assertNotIn("read installed.load cache", phases)
+        cached, phases = run()
+        self.assertMultiLineEqual(rebuilt, cached)
+        self.assertIn("read installed.load cache", phases)
+        self.assertNotIn("read installed.scan", phases)
+        uncached, phases = run("--no-cache")
+        self.assertMultiLineEqual(rebuilt, uncached)
+        self.assertIn("read installed.scan", phases)
+        self.assertFalse(cache_phases & phases)
+        real_cwd = os.getcwd()
+        self.pip_install("{}/test_packages/extraneous_extras_sub_package".format(real_cwd))
+        try:
+            installed, phases = run()
+        finally:
+            self.pip_install("extraneous_extras_sub_package", uninstall=True)
+        self.assertIn("read installed.scan", phases)
+        self.assertIn("extraneous-extras-sub-package", installed)
+        uninstalled, phases = run()
+        self.assertIn("read installed.scan", phases)
+        self.assertMultiLineEqual(rebuilt, uninstalled)
+        run()
+        # rewriting metadata in place leaves the directory's mtime alone.
+        with self.dangling_requirement("extraneous_top_package_4", "extraneous-not-installed"):
+            rewritten, phases = run("-v")
+            self.assertIn("read installed.scan", phases)
+            self.assertMultiLineEqual(run("-v --no-cache")[0], rewritten)
+        restored, phases = run()
+        self.assertIn("read installed.scan", phases)
+        self.assertMultiLineEqual(rebuilt, restored)
+
+    def test_timings_profile(self):
+        profile_path = os.path.join(self.cwd_path, "extraneous.pstats")
+        extraneous = self.subcmd("`which extraneous.py` -v", coverage=True)
+        timed = self.subcmd("`which extraneous.py` -v --timings json --profile {}".format(profile_path), coverage=True)
+        self.assertMultiLineEqual(extraneous.stdout.decode("utf8"), timed.stdout.decode("utf8"))
+        timings = json.loads(timed.stderr.decode("utf8"))
+        phases = [phase["name"] for phase in timings["phases"]]
+        for phase in ["read installed", "read requirements", "read requirements.parse", "closure", "print"]:
+            self.assertIn(phase, phases)
+        self.assertEqual(2, timings["counters"]["requirement files"])
+        self.assertGreater(timings["counters"]["packages"], 0)
+        self.assertGreater(timings["peak_memory"], 0)
+        self.assertTrue(os.path.exists(profile_path))
+        text = self.subcmd("`which extraneous.py` --timings", coverage=True)
+        self.assertIn("timings:\n    read installed", text.stderr.decode("utf8"))
+
+    def test_benchmarks(self):
+        results_path = os.path.join(self.cwd_path, "bench.json")
+        benchmarks = "python {}/benchmarks.py --sizes 100 --repeat 1".format(os.getcwd())
+        self.subcmd("{} --output {}".format(benchmarks, results_path))
+        with open(results_path) as results_file:
+            results = json.load(results_file)
+        self.assertEqual(
+            [
+                "build_graph",
+                "find_requirements_unique_to_projects",
+                "read_installed",
+                "read_installed_cached",
+                "read_requirements",
+            ],
+            sorted(results["results"]["100"]["phases"]),
+        )
+        self.assertEqual(100, results["results"]["100"]["installed"])
+        # the same seed generates the same environment, so only the timings can differ from the baseline.
+        compared = self.subcmd("{} --baseline {} --threshold 1000".format(benchmarks, results_path))
+        self.assertNotIn("regression:", compared.stdout.decode("utf8"))
+
+    def test_io_workers(self):
+        serial = self.subcmd("`which extraneous.py` -v --no-cache", coverage=True)
+        threaded = self.subcmd("`which extraneous.py` -v --no-cache --io-workers 4", coverage=True)
+        self.assertMultiLineEqual(serial.stdout.decode("utf8"), threaded.stdout.decode("utf8"))
+
+    def test_include_recursive(self):
+        with TemporaryDirectory() as monorepo:
+            for path, requirement in [
+                ("services/a/requirements.txt", "extraneous-top-package-2"),
+                ("services/b/dev-requirements.txt", "extraneous-top-package-4"),
+                ("services/b/notes.txt", "extraneous-sub-package-2"),
+                ("services/b/deep/deeper/requirements.txt", "extraneous-sub-package-2"),
+                ("build/requirements.txt", "extraneous-sub-package-2"),
+                ("venv/pyvenv.cfg", "home = /usr/bin"),
+                ("venv/requirements.txt", "extraneous-sub-package-2"),
+            ]:
+                os.makedirs(os.path.join(monorepo, os.path.dirname(path)), exist_ok=True)
+                with open(os.path.join(monorepo, path), mode="w") as w:
+                    w.write(requirement + "\n")
+            for io_workers in [1, 4]:
+                ran = self.subcmd(
+                    "`which extraneous.py` -v --include-recursive . --include-recursive {} --ignore build/"
+                    " --max-depth 3 --io-workers {}".format(monorepo, io_workers),
+                    coverage=True,
+                )
+                output = ran.stdout.decode("utf8")
+                self.assertIn(
+                    "reading requirements from:\n\trequirements.txt\n\ttest_requirements.txt\n"
+                    "\t{monorepo}/services/a/requirements.txt\n\t{monorepo}/services/b/dev-requirements.txt\n".format(
+                        monorepo=monorepo
+                    ),
+                    output,
+                )
+                self.assertNotIn("extraneous-top-package", output)
+
+    def test_unnamed_requirements_only(self):
+        with TemporaryDirectory() as project:
+            with open(os.path.join(project, "requirements.txt"), mode="w") as w:
+                w.write("-e .\n./vendor/lib\n")
+            with self.assertRaises(subprocess.CalledProcessError) as raised:
+                self.subcmd("`which extraneous.py`", cwd_path=project)
+            self.assertIn("No requirements found.", raised.exception.stderr.decode("utf8"))
+
+    def test_site_packages(self):
+        full = self.subcmd("`which extraneous.py` -f", coverage=True)
+        # the editable install of extraneous itself is only found through its egg-link and easy-install.pth.
+        foreign = self.subcmd(
+            "`which extraneous.py` -f --no-cache --site-packages {}".format(self.env_path), coverage=True
+        )
+        self.assertMultiLineEqual(full.stdout.decode("utf8"), foreign.stdout.decode("utf8"))
+        with TemporaryDirectory() as envs:
+            env_root = os.path.join(envs, "foreign")
+            site_packages = os.path.join(env_root, "lib", "python3.9", "site-packages")
+            os.makedirs(os.path.join(env_root, "src", "linked", "linked.egg-info"))
+            os.makedirs(os.path.join(site_packages, "zipped_sub-1.0.dist-info"))
+            with open(os.path.join(env_root, "src", "linked", "linked.egg-info", "PKG-INFO"), mode="w") as w:
+                w.write("Name: linked\nVersion: 0.1\n")
+            with open(os.path.join(site_packages, "linked.egg-link"), mode="w") as w:
+                w.write("../../../src/linked\n.")
+            with zipfile.ZipFile(os.path.join(site_packages, "zipped-1.0-py3.9.egg"), mode="w") as egg:
+                egg.writestr("EGG-INFO/PKG-INFO", "Name: zipped\nVersion: 1.0\n")
+                egg.writestr("EGG-INFO/requires.txt", "zipped-sub\n\n[test]\nnever-installed\n")
+            with open(os.path.join(site_packages, "zipped_sub-1.0.dist-info", "METADATA"), mode="w") as w:
+                w.write("Name: zipped-sub\nVersion: 1.0\n")
+            with open(os.path.join(site_packages, "easy-install.pth"), mode="w") as w:
+                w.write("import sys; sys.__plen = len(sys.path)\n./zipped-1.0-py3.9.egg\n./missing-2.0-py3.9.egg\n")
+            ran = self.subcmd("`which extraneous.py` --site-packages {} --format json".format(env_root), coverage=True)
+            self.assertEqual(
+                [("linked", True, []), ("zipped", False, ["zipped-sub"])],
+                [(x["name"], x["editable"], x["uninstall"]) for x in json.loads(ran.stdout.decode("utf8"))],
+            )
+            envs_path = os.path.join(envs, "envs.txt")
+            with open(envs_path, mode="w") as w:
+                w.write("foreign {}\n".format(self.cwd_path))
+            ran = self.subcmd("`which extraneous.py` --envs {}".format(envs_path), coverage=True)
+            self.assertMultiLineEqual(
+                "{} ({}):\n{}\nuninstall via:\n\tpip uninstall -y linked zipped zipped-sub\n".format(
+                    env_root, self.cwd_path, color("extraneous packages:\n\tlinked zipped", fg="yellow")
+                ),
+                ran.stdout.decode("utf8"),
+            )
+
+    def test_analyzer(self):
+        script_path = os.path.join(self.cwd_path, "analyzer.py")
+        with open(script_path, mode="w") as w:
+            w.write(
+                """import json
+from extraneous import Analyzer
+from extraneous.extraneous import timer
+
+timer.start()
+analyzer = Analyzer()
+results = [analyzer.find_extraneous()]
+analyzer.exclude = ["extraneous-top-package-2"]
+results.append(analyzer.find_extraneous())
+analyzer.full = True
+results.append(analyzer.find_extraneous())
+analyzer.requirements = ["extraneous-top-package-4"]
+results.append(analyzer.find_extraneous())
+calls = {x["name"]: x["calls"] for x in timer.results()["phases"]}
+print(json.dumps({"results": [[sorted(x) for x in result] for result in results], "calls": calls}))
+"""
+            )
+        ran = self.subcmd("python {}".format(script_path))
+        output = json.loads(ran.stdout.decode("utf8"))
+        sub_packages = ["extraneous-sub-package-3", "extraneous-sub-sub-package-1", "extraneous-sub-sub-package-2"]
+        self.assertEqual(
+            [
+                [["extraneous-top-package-2", "extraneous-top-package-4"], ["extraneous-sub-package-2"] + sub_packages],
+                [["extraneous-top-package-4"], sub_packages],
+                [
+                    ["extraneous", "extraneous-top-package-4", "setuptools"],
+                    ["ansicolors"] + sub_packages + ["pip", "pipdeptree"],
+                ],
+            ],
+            output["results"][:3],
+        )
+        self.assertNotIn("extraneous-top-package-4", output["results"][3][0])
+        self.assertEqual(
+            {"read installed": 1, "read requirements": 1, "closure": 4},
+            {name: output["calls"][name] for name in ["read installed", "read requirements", "closure"]},
+        )
+
+    def test_root_still_required(self):
+        script_path = os.path.join(self.cwd_path, "still_required.py")
+        with open(script_path, mode="w") as w:
+            w.write(
+                """import json
+from extraneous.extraneous import PackageGraph, find_requirements_unique_to_projects
+
+graph = PackageGraph.from_name_tree({"app": ["lib"], "lib": ["dep"], "dep": [], "tool": ["dep"]})
+results = [
+    find_requirements_unique_to_projects(graph, {"app"}, ["lib"], set()),
+    find_requirements_unique_to_projects(graph, {"app"}, ["lib", "tool"], set()),
+    find_requirements_unique_to_projects(graph, set(), ["lib", "tool", "app"], set()),
+]
+print(json.dumps([sorted(x) for x in results]))
+"""
+            )
+        ran = self.subcmd("python {}".format(script_path))
+        # lib stays while app requires it, and so does dep, until app is uninstalled too.
+        self.assertEqual(
+            [["lib"], ["lib", "tool"], ["app", "dep", "lib", "tool"]], json.loads(ran.stdout.decode("utf8"))
+        )
+
+    def test_orphans(self):
+        site_packages = os.path.join(self.cwd_path, self.get_sitepackages_for_venv().split("\n\t")[0])
+        orphans = {
+            "leftover_package": True,
+            "stray.so": False,
+            os.path.join("pip", "leftover.py"): False,
+            os.path.join("pip", "__pycache__", "gone.cpython-39.pyc"): False,
+        }
+        os.makedirs(os.path.join(site_packages, "leftover_package", "sub"))
+        os.makedirs(os.path.join(site_packages, "pip", "__pycache__"), exist_ok=True)
+        try:
+            for path in ["leftover_package/sub/module.py", "stray.so"] + list(orphans)[2:]:
+                with open(os.path.join(site_packages, path), mode="w") as w:
+                    w.write("1234")
+            ran = self.subcmd("`which extraneous.py` --orphans --format json --io-workers 4", coverage=True)
+            found = {x["path"]: (x["directory"], x["size"]) for x in json.loads(ran.stdout.decode("utf8"))}
+            self.assertEqual({path: (is_dir, 4) for path, is_dir in orphans.items()}, {x: found[x] for x in orphans})
+            self.assertFalse([x for x in found if x.startswith("extraneous") and x not in orphans])
+            ran = self.subcmd("`which extraneous.py` --orphans", coverage=True)
+            self.assertIn("{}leftover_package/ (4 B)\n".format(os.sep), ran.stdout.decode("utf8"))
+        finally:
+            self.subcmd("rm -rf {}".format(" ".join(os.path.join(site_packages, x) for x in orphans)))
+
+    def test_sizes(self):
+        site_packages = os.path.join(self.cwd_path, self.get_sitepackages_for_venv().split("\n\t")[0])
+        # *.dist-info with a RECORD, or *.egg-info with an installed-files.txt when pip installs without wheel.
+        removed = glob.glob(os.path.join(site_packages, "extraneous_top_package_2-1.0.0*-info"))[0]
+        kept = glob.glob(os.path.join(site_packages, "extraneous_top_package_1-1.0.0*-info"))[0]
+
+        def manifest(metadata_path):
+            if metadata_path.endswith(".dist-info"):
+                return os.path.join(metadata_path, "RECORD"), "shared_module.py,sha256=,1000\n"
+            return os.path.join(metadata_path, "installed-files.txt"), "../shared_module.py\n"
+
+        originals = {}
+        for path in [manifest(removed)[0], manifest(kept)[0], os.path.join(kept, "top_level.txt")]:
+            if os.path.exists(path):
+                with open(path) as original:
+                    originals[path] = original.read()
+            else:
+                originals[path] = None
+
+        def measure():
+            ran = self.subcmd("`which extraneous.py` --sizes --format json", coverage=True)
+            records = {x["name"]: x for x in json.loads(ran.stdout.decode("utf8"))}
+            return records["extraneous-top-package-2"]["sizes"]["extraneous-top-package-2"]
+
+        before = measure()
+        try:
+            with open(os.path.join(site_packages, "shared_module.py"), mode="w") as w:
+                w.write("#" * 1000)
+            path, line = manifest(removed)
+            with open(path, mode="a") as a:
+                a.write(line)
+            # the manifest itself is measured too, by its size on disk.
+            self.assertEqual(before + 1000 + len(line), measure())
+            path, kept_line = manifest(kept)
+            with open(path, mode="a") as a:
+                a.write(kept_line)
+            with open(os.path.join(kept, "top_level.txt"), mode="w") as w:
+                w.write("shared_module\n")
+            # a package that stays keeps the file.
+            self.assertEqual(before + len(line), measure())
+            # also when its top_level.txt doesn't tell, like a wheel built without setuptools.
+            os.unlink(os.path.join(kept, "top_level.txt"))
+            self.assertEqual(before + len(line), measure())
+            ran = self.subcmd("`which extraneous.py` --sizes", coverage=True)
+            self.assertIn("reclaimable space:\n", ran.stdout.decode("utf8"))
+            self.assertIn("\ttotal ", ran.stdout.decode("utf8"))
+        finally:
+            for path, content in originals.items():
+                if content is None:
+                    if os.path.exists(path):
+                        os.unlink(path)
+                    continue
+                with open(path, mode="w") as w:
+                    w.write(content)
+            os.unlink(os.path.join(site_packages, "shared_module.py"))
+
+    def test_rank(self):
+        ran = self.subcmd("`which extraneous.py` --rank --format json", coverage=True)
+        records = json.loads(ran.stdout.decode("utf8"))
+        packages = {x["name"]: x["packages"] for x in records}
+        self.assertEqual(
+            ["extraneous-sub-package-3", "extraneous-sub-sub-package-1", "extraneous-sub-sub-package-2"],
+            packages["extraneous-top-package-4"],
+        )
+        self.assertEqual(["extraneous-sub-package-2"], packages["extraneous-top-package-2"])
+        # required by both top packages 1 and 2, so neither keeps it alone.
+        self.assertEqual([], packages["extraneous-sub-package-1"])
+        self.assertEqual([], packages["extraneous-top-package-1"])
+        self.assertEqual("extraneous-top-package-4", records[0]["name"])
+        # every installed package is listed once.
+        listed = [x["name"] for x in records] + [y for x in records for y in x["packages"]]
+        self.assertEqual(len(listed), len(set(listed)))
+        self.assertIn("extraneous-sub-sub-package-2", listed)
+        ran = self.subcmd("`which extraneous.py` --rank --sizes", coverage=True)
+        self.assertIn("packages only kept installed by each package:\n", ran.stdout.decode("utf8"))
+        self.assertRegex(
+            ran.stdout.decode("utf8"), r"\textraneous-top-package-4 +3 +[0-9.]+ KiB  extraneous-sub-package-3"
+        )
+
+    def test_snapshot(self):
+        real_cwd = os.getcwd()
+        before_path = os.path.join(self.cwd_path, "before.bin")
+        after_path = os.path.join(self.cwd_path, "after.bin")
+        self.subcmd("`which extraneous.py` --snapshot {}".format(before_path), coverage=True)
+        extraneous = self.subcmd("`which extraneous.py`", coverage=True)
+        against = self.subcmd("`which extraneous.py` --against {}".format(before_path), coverage=True)
+        self.assertMultiLineEqual(extraneous.stdout.decode("utf8"), against.stdout.decode("utf8"))
+        self.pip_install("{}/test_packages/extraneous_extras_sub_package".format(real_cwd))
+        try:
+            self.subcmd("`which extraneous.py` --snapshot {}".format(after_path), coverage=True)
+        finally:
+            self.pip_install("extraneous_extras_sub_package", uninstall=True)
+        diff = self.subcmd("`which extraneous.py` --diff {} {}".format(before_path, after_path), coverage=True)
+        self.assertMultiLineEqual(
+            "added packages:\n\textraneous-extras-sub-package==1.0.0\n", diff.stdout.decode("utf8")
+        )
+        diff = self.subcmd("`which extraneous.py` --diff {} {}".format(after_path, after_path), coverage=True)
+        self.assertMultiLineEqual("no differences\n", diff.stdout.decode("utf8"))
+
+    def test_installed_from(self):
+        wheelhouse = os.path.join(self.cwd_path, "wheelhouse")
+        freeze_path = os.path.join(self.cwd_path, "freeze.txt")
+        index_path = os.path.join(self.cwd_path, "index.json")
+        os.makedirs(wheelhouse, exist_ok=True)
+        with zipfile.ZipFile(os.path.join(wheelhouse, "frozen_top-1.0-py3-none-any.whl"), mode="w") as wheel:
+            wheel.writestr(
+                "frozen_top-1.0.dist-info/METADATA",
+                "Metadata-Version: 2.1\nName: frozen-top\nVersion: 1.0\nRequires-Dist: frozen-sub\n"
+                "Requires-Dist: frozen-python-2 ; python_version < '3'\n",
+            )
+        with open(index_path, mode="w") as w:
+            json.dump({"frozen-sub": {"2.0": ["frozen-sub-sub (>=1.0)"], "1.0": []}}, w)
+        with open(freeze_path, mode="w") as w:
+            w.write(
+                "frozen-top==1.0\nfrozen-sub==2.0\nfrozen-sub-sub==1.0\nfrozen-python-2==1.0\n"
+                "# Editable install with no version control (frozen-editable==0.1)\n-e /src/frozen-editable\n"
+            )
+        extraneous = self.subcmd(
+            "`which extraneous.py` -v --format json --installed-from {} --metadata-from {} --metadata-from {}".format(
+                freeze_path, wheelhouse, index_path
+            ),
+            coverage=True,
+        )
+        self.assertEqual(
+            {
+                "frozen-editable": ("0.1", True, []),
+                "frozen-python-2": ("1.0", False, []),
+                "frozen-top": ("1.0", False, ["frozen-sub", "frozen-sub-sub"]),
+            },
+            {
+                record["name"]: (record["version"], record["editable"], record["uninstall"])
+                for record in json.loads(extraneous.stdout.decode("utf8"))
+            },
+        )
+        self.assertIn(
+            "no metadata for:\n\tfrozen-editable frozen-python-2 frozen-sub-sub", extraneous.stderr.decode("utf8")
+        )
+
+    def test_image_tar(self):
+        image_dir = os.path.join(self.cwd_path, "image")
+        image_path = os.path.join(image_dir, "image.tar")
+        site_packages = "usr/local/lib/python3.9/site-packages"
+        layers = [
+            {
+                "{}/image_top-1.0.dist-info/METADATA".format(site_packages): "Name: image-top\nVersion: 1.0\n"
+                "Requires-Dist: image-sub\n",
+                "{}/image_sub-1.0.dist-info/METADATA".format(site_packages): "Name: image-sub\nVersion: 1.0\n",
+                "{}/image_gone-1.0.dist-info/METADATA".format(site_packages): "Name: image-gone\nVersion: 1.0\n",
+                "{}/image_gone/__init__.py".format(site_packages): "",
+                "{}/image_editable-0.1.dist-info/METADATA".format(
+                    site_packages
+                ): "Name: image-editable\nVersion: 0.1\n",
+                "{}/image_editable-0.1.dist-info/direct_url.json".format(site_packages): json.dumps(
+                    {"url": "file:///src", "dir_info": {"editable": True}}
+                ),
+                "app/requirements.txt": "image-top\n",
+                "app/dev-requirements.txt": "image-new\n",
+            },
+            {
+                "{}/.wh.image_gone-1.0.dist-info".format(site_packages): "",
+                "{}/.wh.image_gone".format(site_packages): "",
+                "{}/image_new-2.0.dist-info/METADATA".format(site_packages): "Name: image-new\nVersion: 2.0\n"
+                "Requires-Dist: image-python-2 ; python_version < '3'\n",
+                "app/.wh..wh..opq": "",
+                "app/requirements.txt": "-r base.txt\n",
+                "app/base.txt": "image-top\n",
+            },
+        ]
+        os.makedirs(image_dir, exist_ok=True)
+
+        def add_file(tar, name, content):
+            if not isinstance(content, bytes):
+                content = content.encode("utf8")
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+
+        with tarfile.open(image_path, mode="w") as image:
+            add_file(image, "config.json", json.dumps({"os": "linux", "config": {"WorkingDir": "/app"}}))
+            for number, layer in enumerate(layers):
+                layer_file = io.BytesIO()
+                # docker save layers are plain tarballs, but compressed ones are read too.
+                with tarfile.open(fileobj=layer_file, mode="w:gz" if number else "w") as layer_tar:
+                    for name, content in layer.items():
+                        add_file(layer_tar, name, content)
+                add_file(image, "layer{}.tar".format(number), layer_file.getvalue())
+            add_file(
+                image,
+                "manifest.json",
+                json.dumps([{"Config": "config.json", "Layers": ["layer0.tar", "layer1.tar"]}]),
+            )
+        extraneous = self.subcmd(
+            "`which extraneous.py` -v --format json --image-tar {}".format(image_path),
+            cwd_path=image_dir,
+            coverage=True,
+        )
+        records = json.loads(extraneous.stdout.decode("utf8"))
+        self.assertEqual(
+            {"image-editable": ("0.1", True, []), "image-new": ("2.0", False, [])},
+            {record["name"]: (record["version"], record["editable"], record["uninstall"]) for record in records},
+        )
+        # the opaque whiteout of /app hides dev-requirements.txt, which required image-new.
+        for record in records:
+            self.assertEqual(["/app/requirements.txt", "/app/base.txt"], record["requirement_files"])
+        self.assertIn(
+            "reading installed from:\n\t/{} in {}\n".format(site_packages, image_path),
+            extraneous.stderr.decode("utf8"),
+        )
+
+    def test_apply(self):
+        real_cwd = os.getcwd()
+        removed = ["extraneous_top_package_2", "extraneous_top_package_4", "extraneous_sub_package_2"]
+        removed += ["extraneous_sub_package_3", "extraneous_sub_sub_package_1", "extraneous_sub_sub_package_2"]
+        order = (
+            "uninstall order:\n"
+            "\textraneous-top-package-2 extraneous-top-package-4\n"
+            "\textraneous-sub-package-2 extraneous-sub-package-3\n"
+            "\textraneous-sub-sub-package-1 extraneous-sub-sub-package-2\n"
+        )
+        installed = self.subcmd("python -m pip list").stdout.decode("utf8")
+        for package in removed:
+            self.assertIn(package.replace("_", "-"), installed)
+        try:
+            # a requirement that isn't installed has nothing to remove and doesn't stop the others.
+            with self.dangling_requirement("extraneous_top_package_4", "extraneous-not-installed"):
+                dry_run = self.subcmd("`which extraneous.py` --no-cache --dry-run", coverage=True)
+                self.assertIn(order + "would remove ", dry_run.stdout.decode("utf8"))
+                applied = self.subcmd("`which extraneous.py` --no-cache --apply --io-workers 2", coverage=True)
+            self.assertIn(order + "removed ", applied.stdout.decode("utf8"))
+            installed = self.subcmd("python -m pip list").stdout.decode("utf8")
+            for package in removed:
+                self.assertNotIn(package.replace("_", "-"), installed)
+            extraneous = self.subcmd("`which extraneous.py`", coverage=True)
+            self.assertMultiLineEqual("", extraneous.stdout.decode("utf8"))
+        finally:
+            self.pip_install(" ".join("{}/test_packages/{}".format(real_cwd, package) for package in removed))
+
+    def test_why_what_if(self):
+        why = self.subcmd("`which extraneous.py` --why extraneous_sub_package_1", coverage=True)
+        self.assertMultiLineEqual(
+            "extraneous-sub-package-1 is required through:\n\textraneous-top-package-1 -> extraneous-sub-package-1\n",
+            why.stdout.decode("utf8"),
+        )
+        why = self.subcmd("`which extraneous.py` --why extraneous-sub-package-2", coverage=True)
+        self.assertMultiLineEqual(
+            "extraneous-sub-package-2 isn't required by the requirements files or excluded packages\n",
+            why.stdout.decode("utf8"),
+        )
+        what_if = self.subcmd("`which extraneous.py` --what-if extraneous-top-package-4", coverage=True)
+        self.assertMultiLineEqual(
+            "uninstalling extraneous-top-package-4 also removes:\n"
+            "\textraneous-sub-package-3 extraneous-sub-sub-package-1 extraneous-sub-sub-package-2\n",
+            what_if.stdout.decode("utf8"),
+        )
+        # still required by extraneous-top-package-4, which stays, so its requirements stay too.
+        what_if = self.subcmd("`which extraneous.py` --what-if extraneous-sub-package-3", coverage=True)
+        self.assertMultiLineEqual(
+            "uninstalling extraneous-sub-package-3 removes nothing else\n"
+            "extraneous-sub-package-3 is still required by:\n\textraneous-top-package-4\n",
+            what_if.stdout.decode("utf8"),
+        )
+        what_if = self.subcmd("`which extraneous.py` --what-if extraneous-sub-package-1 --format json", coverage=True)
+        self.assertEqual(
+            {
+                "what_if": ["extraneous-sub-package-1"],
+                "uninstall": [],
+                "required_by": {"extraneous-sub-package-1": ["extraneous-top-package-1", "extraneous-top-package-2"]},
+            },
+            json.loads(what_if.stdout.decode("utf8")),
+        )
+
+    def test_serve_client(self):
+        socket_path = os.path.join(self.cwd_path, "extraneous.sock")
+        server = subprocess.Popen(
+            "exec coverage run -p `which extraneous.py` --serve --socket {}".format(socket_path),
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=self.cwd_path,
+            env=self.env_vars,
+        )
+        try:
+            for _ in range(100):
+                if os.path.exists(socket_path):
+                    break
+                time.sleep(0.1)
+            self.assertTrue(os.path.exists(socket_path))
+            extraneous = self.subcmd("`which extraneous.py` -v", coverage=True)
+            client = self.subcmd("`which extraneous.py` -v --client --socket {}".format(socket_path), coverage=True)
+            self.assertMultiLineEqual(extraneous.stdout.decode("utf8"), client.stdout.decode("utf8"))
+            why = self.subcmd("`which extraneous.py` --why extraneous-sub-package-1", coverage=True)
+            client = self.subcmd(
+                "`which extraneous.py` --why extraneous-sub-package-1 --client --socket {}".format(socket_path),
+                coverage=True,
+            )
+            self.assertMultiLineEqual(why.stdout.decode("utf8"), client.stdout.decode("utf8"))
+        finally:
+            server.terminate()
+            server.communicate()
+        self.assertFalse(os.path.exists(socket_path))
+
     def test_exclude_top(self):
         extraneous = self.subcmd(
             "`which extraneous.py` -e extraneous-top-package-2 -e extraneous-top-package-4", coverage=True
@@ -392,3 +1062,114 @@ exclude_lines =
                 os.unlink("{cwd_path}/local_requirements.txt".format(cwd_path=self.cwd_path))
         finally:
             self.pip_install("extraneous_SubCased_package extraneous_CASED_package", uninstall=True)
+
+    def test_dependency_cycle(self):
+        real_cwd = os.getcwd()
+        cycle_packages = ["extraneous_cycle_package_1", "extraneous_cycle_package_2", "extraneous_top_package_5"]
+        self.pip_install(" ".join("{}/test_packages/{}".format(real_cwd, package) for package in cycle_packages))
+        try:
+            extraneous = self.subcmd("`which extraneous.py`", coverage=True)
+            self.assertMultiLineEqual(
+                "{extraneous}\n"
+                "uninstall via:\n\tpip uninstall -y {uninstall}\n".format(
+                    extraneous=color(
+                        "extraneous packages:\n\t{}".format(
+                            " ".join(
+                                sorted(
+                                    {"extraneous-top-package-2", "extraneous-top-package-4", "extraneous-top-package-5"}
+                                )
+                            )
+                        ),
+                        fg="yellow",
+                    ),
+                    uninstall=" ".join(
+                        sorted({"extraneous-top-package-2", "extraneous-top-package-4", "extraneous-top-package-5"})
+                        + sorted(
+                            {
+                                "extraneous-cycle-package-1",
+                                "extraneous-cycle-package-2",
+                                "extraneous-sub-package-2",
+                                "extraneous-sub-package-3",
+                                "extraneous-sub-sub-package-1",
+                                "extraneous-sub-sub-package-2",
+                            }
+                        )
+                    ),
+                ),
+                extraneous.stdout.decode("utf8"),
+            )
+        finally:
+            self.pip_install(" ".join(cycle_packages), uninstall=True)
+
+    def test_requirements_file_references(self):
+        with TemporaryDirectory() as other_req_dir:
+            with open(os.path.join(other_req_dir, "base.txt"), mode="w") as w:
+                w.write(
+                    "# included by local_requirements.txt\n"
+                    "extraneous_top_package_2[extra] >= 1.0 ; python_version >= '3' \\\n"
+                    "    --hash=sha256:0000000000000000000000000000000000000000000000000000000000000000\n"
+                    "-c constraints.txt\n"
+                )
+            with open(os.path.join(other_req_dir, "constraints.txt"), mode="w") as w:
+                w.write("extraneous-top-package-4<2\n")
+            with open("{cwd_path}/local_requirements.txt".format(cwd_path=self.cwd_path), mode="w") as w:
+                w.write("--index-url https://pypi.org/simple\n-r {}\n".format(os.path.join(other_req_dir, "base.txt")))
+            try:
+                extraneous = self.subcmd("`which extraneous.py`", coverage=True)
+                self.assertMultiLineEqual(
+                    "{extraneous}\n"
+                    "uninstall via:\n\tpip uninstall -y {uninstall}\n".format(
+                        extraneous=color("extraneous packages:\n\textraneous-top-package-4", fg="yellow"),
+                        uninstall=" ".join(
+                            ["extraneous-top-package-4"]
+                            + sorted(
+                                {
+                                    "extraneous-sub-package-3",
+                                    "extraneous-sub-sub-package-1",
+                                    "extraneous-sub-sub-package-2",
+                                }
+                            )
+                        ),
+                    ),
+                    extraneous.stdout.decode("utf8"),
+                )
+            finally:
+                os.unlink("{cwd_path}/local_requirements.txt".format(cwd_path=self.cwd_path))
+
+    def test_extras_and_markers(self):
+        real_cwd = os.getcwd()
+        extras_packages = ["extraneous_extras_package", "extraneous_extras_sub_package"]
+        self.pip_install(" ".join("{}/test_packages/{}".format(real_cwd, package) for package in extras_packages))
+        local_requirements = "{cwd_path}/local_requirements.txt".format(cwd_path=self.cwd_path)
+        # extraneous-sub-package-2 is only required by extraneous-extras-package for python 2.
+        uninstall = ["extraneous-sub-package-2", "extraneous-sub-package-3"]
+        uninstall += ["extraneous-sub-sub-package-1", "extraneous-sub-sub-package-2"]
+        try:
+            with open(local_requirements, mode="w") as w:
+                w.write("extraneous-extras-package[Optional]\n")
+            extraneous = self.subcmd("`which extraneous.py`", coverage=True)
+            self.assertMultiLineEqual(
+                "{extraneous}\n"
+                "uninstall via:\n\tpip uninstall -y {uninstall}\n".format(
+                    extraneous=color(
+                        "extraneous packages:\n\textraneous-top-package-2 extraneous-top-package-4", fg="yellow"
+                    ),
+                    uninstall=" ".join(["extraneous-top-package-2", "extraneous-top-package-4"] + uninstall),
+                ),
+                extraneous.stdout.decode("utf8"),
+            )
+            with open(local_requirements, mode="w") as w:
+                w.write("extraneous-extras-package\n")
+            extraneous = self.subcmd("`which extraneous.py`", coverage=True)
+            top = ["extraneous-extras-sub-package", "extraneous-top-package-2", "extraneous-top-package-4"]
+            self.assertMultiLineEqual(
+                "{extraneous}\n"
+                "uninstall via:\n\tpip uninstall -y {uninstall}\n".format(
+                    extraneous=color("extraneous packages:\n\t{}".format(" ".join(top)), fg="yellow"),
+                    uninstall=" ".join(top + uninstall),
+                ),
+                extraneous.stdout.decode("utf8"),
+            )
+        finally:
+            os.unlink(local_requirements)
+            self.pip_install(" ".join(extras_packages), uninstall=True)